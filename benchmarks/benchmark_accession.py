@@ -0,0 +1,513 @@
+#!/usr/bin/python3
+"""Offline benchmark of Analysis construction, graph searches and accessioning
+
+Generates synthetic Cromwell metadata shaped like the ATAC-seq pipeline,
+serves its files from a MemoryBackend and accessions them to an in-memory
+stand-in for the ENCODE portal. Both stand-ins take an injectable
+per-request latency. Wall time, peak memory and requests per endpoint are
+reported for each phase as json.
+"""
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+import requests
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from accessioning import Accession  # noqa: E402
+from portal import SharedState  # noqa: E402
+from profiler import Profiler  # noqa: E402
+from storage_backends import MemoryBackend  # noqa: E402
+
+
+ROOT = 'mem://benchmark/atac/'
+
+QC_TYPES = {
+    'idr-quality-metrics':                  'IDRQualityMetric',
+    'samtools-flagstats-quality-metric':    'SamtoolsFlagstatsQualityMetric',
+    'complexity-xcorr-quality-metrics':     'ComplexityXcorrQualityMetric'
+}
+
+
+class FakePortal(object):
+    """In-memory ENCODE portal implementing the Connection methods used"""
+    ENCID_KEY = '_enc_id'
+    PROFILE_KEY = '_profile'
+
+    def __init__(self, latency=0):
+        self.dcc_url = 'https://benchmark.invalid'
+        self.auth = None
+        self.latency = latency
+        self.requests = {}
+        # Objects keyed by accession, @id and aliases
+        self.objects = {}
+        self.count = 0
+
+    def request(self, name):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add(self, obj):
+        self.count += 1
+        accession_id = obj.get('accession', 'ENCFF{:06d}'.format(self.count))
+        obj = dict(obj)
+        obj.update({'accession': accession_id,
+                    '@id': '/files/{}/'.format(accession_id)})
+        obj.setdefault('quality_metrics', [])
+        # Files are found by md5:<md5sum> as on the portal
+        keys = [accession_id, obj['@id']] + obj.get('aliases', [])
+        if 'md5sum' in obj:
+            keys.append('md5:{}'.format(obj['md5sum']))
+        for key in keys:
+            self.objects[key] = obj
+        return obj
+
+    def lookup(self, identifier):
+        return (self.objects.get(identifier)
+                or self.objects.get(identifier.strip('/').split('/')[-1]))
+
+    def search(self, search_args=[], url=None, limit=None):
+        self.request('search')
+        md5sums = {value for key, value in search_args if key == 'md5sum'}
+        accessions = {value
+                      for key, value in search_args
+                      if key == 'accession'}
+        fields = [value for key, value in search_args if key == 'field']
+        unique = {id(obj): obj for obj in self.objects.values()}
+        return [self.select_fields(copy.deepcopy(obj), fields)
+                for obj in unique.values()
+                if obj.get('md5sum') in md5sums
+                or obj.get('accession') in accessions]
+
+    # Search results with field parameters have only those properties,
+    # e.g. quality_metrics.@type, and leave out empty arrays like the portal
+    def select_fields(self, obj, fields):
+        if not fields:
+            return obj
+        selected = {}
+        for field in fields:
+            key, _, embedded = field.partition('.')
+            value = obj.get(key)
+            if value is None or value == []:
+                continue
+            if embedded:
+                value = [{embedded: item[embedded]} for item in value]
+            selected[key] = value
+        return selected
+
+    def get(self, rec_ids, database=False, ignore404=True, frame=None):
+        self.request('get')
+        if isinstance(rec_ids, str):
+            rec_ids = [rec_ids]
+        for rec_id in rec_ids:
+            obj = self.lookup(rec_id)
+            if obj:
+                return copy.deepcopy(obj)
+        return {}
+
+    def post(self, payload, require_aliases=True):
+        self.request('post')
+        payload = dict(payload)
+        profile = payload.pop(self.PROFILE_KEY)
+        for alias in payload.get('aliases', []):
+            if alias in self.objects:
+                return copy.deepcopy(self.objects[alias])
+        if profile in QC_TYPES:
+            payload['@type'] = [QC_TYPES[profile]]
+            for file_id in payload['quality_metric_of']:
+                self.lookup(file_id)['quality_metrics'].append(payload)
+            return copy.deepcopy(payload)
+        if profile != 'file':
+            payload['@id'] = '/{}/{}/'.format(profile, payload['aliases'][0])
+            for alias in payload['aliases']:
+                self.objects[alias] = payload
+            return copy.deepcopy(payload)
+        for obj in self.objects.values():
+            if (obj.get('md5sum') == payload['md5sum']
+                    and obj.get('status') not in ['deleted', 'revoked']):
+                raise Exception('409 Client Error: Conflict')
+        # Replicates are inherited from derived_from files as on the portal
+        replicates = set()
+        for file_id in payload.get('derived_from', []):
+            replicates.update(self.lookup(file_id)['biological_replicates'])
+        payload['biological_replicates'] = sorted(replicates)
+        return copy.deepcopy(self.add(payload))
+
+    def patch(self, payload, raise_403=True, extend_array_values=True):
+        self.request('patch')
+        payload = dict(payload)
+        obj = self.lookup(payload.pop(self.ENCID_KEY))
+        for key, value in payload.items():
+            if extend_array_values and isinstance(value, list):
+                value = list(dict.fromkeys(obj.get(key, []) + value))
+            obj[key] = value
+        return copy.deepcopy(obj)
+
+
+class PortalAdapter(requests.adapters.BaseAdapter):
+    """Transport sending requests made directly over the portal session,
+    e.g. quality metrics with streamed attachments, to the FakePortal"""
+    def __init__(self, portal):
+        super().__init__()
+        self.portal = portal
+
+    def send(self, request, **kwargs):
+        body = request.body
+        if not isinstance(body, (bytes, str)):
+            body = b''.join(body)
+        payload = json.loads(body)
+        payload[FakePortal.PROFILE_KEY] = urlsplit(request.url).path.strip('/')
+        response = requests.Response()
+        response.status_code = 201
+        response._content = json.dumps(
+            {'@graph': [self.portal.post(payload)]}).encode()
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def path(name):
+    return ROOT + name
+
+
+# Cromwell metadata of an ATAC-seq run with scatter_width replicates.
+# Every task gets files_per_task extra outputs and every replicate
+# extra_tasks additional tasks chained after filter.
+def make_metadata(scatter_width, files_per_task, extra_tasks):
+    calls = {}
+
+    def call(task_name, inputs, outputs, shard=0):
+        outputs = dict(outputs)
+        for index in range(files_per_task):
+            outputs['extra_{}'.format(index)] = path(
+                '{}/shard-{}/extra_{}.txt'.format(task_name, shard, index))
+        calls.setdefault('atac.' + task_name, []).append({
+            'inputs':           inputs,
+            'outputs':          outputs,
+            'shardIndex':       shard,
+            'dockerImageUsed':  'quay.io/encode-dcc/atac-seq-pipeline:v1.1'
+        })
+
+    call('read_genome_tsv', {}, {'genome': {
+        'ref_fa': 'mem://benchmark/genome/GRCh38_no_alt_analysis_set.fa.gz'}})
+    for rep in range(1, scatter_width + 1):
+        fastqs = [path('fastqs/rep{}_R{}.fastq.gz'.format(rep, read))
+                  for read in [1, 2]]
+        prefix = 'rep{}/'.format(rep)
+        call('trim_adapter', {'fastqs': fastqs},
+             {'trimmed_fastqs': [path(prefix + 'trimmed_R{}.fastq.gz'.format(read))
+                                 for read in [1, 2]]}, rep)
+        call('bowtie2', {'fastqs': [path(prefix + 'trimmed_R{}.fastq.gz'.format(read))
+                                    for read in [1, 2]]},
+             {'bam': path(prefix + 'aligned.bam'),
+              'read_len_log': path(prefix + 'read_length.txt')}, rep)
+        call('filter', {'bam': path(prefix + 'aligned.bam')},
+             {'nodup_bam': path(prefix + 'nodup.bam')}, rep)
+        call('xcor', {'nodup_bam': path(prefix + 'nodup.bam')},
+             {'plot_pdf': path(prefix + 'xcor.pdf')}, rep)
+        call('macs2', {'nodup_bam': path(prefix + 'nodup.bam')},
+             {'bfilt_npeak': path(prefix + 'peaks.narrowPeak.gz'),
+              'sig_fc': path(prefix + 'fc.bigwig'),
+              'sig_pval': path(prefix + 'pval.bigwig')}, rep)
+        call('idr_pr', {'peaks': [path(prefix + 'peaks.narrowPeak.gz')]},
+             {'idr_plot': path(prefix + 'idr.png')}, rep)
+        previous = path(prefix + 'nodup.bam')
+        for index in range(extra_tasks):
+            output = path(prefix + 'extra_task_{}.txt'.format(index))
+            call('extra_task_{}'.format(index), {'input': previous},
+                 {'output': output}, rep)
+            previous = output
+    peaks = [path('rep{}/peaks.narrowPeak.gz'.format(rep))
+             for rep in range(1, scatter_width + 1)]
+    plots = [path('rep{}/idr.png'.format(rep))
+             for rep in range(1, scatter_width + 1)]
+    call('reproducibility_idr', {'peaks_pr': peaks, 'plots': plots},
+         {'optimal_peak': path('idr/optimal.narrowPeak.gz')})
+    call('reproducibility_overlap', {'peaks_pr': peaks},
+         {'optimal_peak': path('overlap/optimal.narrowPeak.gz')})
+    call('qc_report', {'peaks': path('idr/optimal.narrowPeak.gz')},
+         {'qc_json': path('qc/qc.json')})
+    return {
+        'workflowRoot': ROOT,
+        'calls':        calls,
+        'inputs':       {'atac.idr_thresh': 0.05, 'atac.paired_end': True},
+        'outputs':      {'atac.qc_report.qc_json': path('qc/qc.json')},
+        'labels':       {'cromwell-workflow-id': 'cromwell-benchmark'}
+    }
+
+
+def make_qc(scatter_width):
+    qc = {key: {} for key in ['idr_frip_qc', 'ataqc', 'nodup_flagstat_qc',
+                              'xcor_score', 'pbc_qc']}
+    for rep in range(1, scatter_width + 1):
+        name = 'rep{}'.format(rep)
+        qc['idr_frip_qc'][name + '-pr'] = {'FRiP': 0.2}
+        qc['ataqc'][name] = {'IDR peaks': [100000]}
+        qc['nodup_flagstat_qc'][name] = {'total': 1000, 'mapped_pct': 99.5}
+        qc['xcor_score'][name] = {'NSC': 1.1, 'RSC': 1.2, 'num_reads': 1000,
+                                  'est_frag_len': 200}
+        qc['pbc_qc'][name] = {'NRF': 0.9, 'PBC1': 0.9, 'PBC2': 9.0}
+    return qc
+
+
+# Contents of every file referenced in the metadata
+def make_files(metadata, scatter_width):
+    files = {}
+
+    def collect(value):
+        if isinstance(value, str) and value.startswith('mem://'):
+            files[value] = value.encode() * 16
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+        elif isinstance(value, dict):
+            for item in value.values():
+                collect(item)
+
+    collect(metadata['calls'])
+    files[path('qc/qc.json')] = json.dumps(make_qc(scatter_width)).encode()
+    for rep in range(1, scatter_width + 1):
+        files[path('rep{}/read_length.txt'.format(rep))] = b'76'
+    return files
+
+
+def make_steps():
+    def step(run, task_name, wdl_files):
+        return {'dcc_step_version': '/analysis-step-versions/{}/'.format(run),
+                'dcc_step_run': run,
+                'wdl_task_name': task_name,
+                'wdl_files': wdl_files}
+
+    def wdl_file(filekey, output_type, file_format, derived_from_task,
+                 derived_from_filekey, inputs=False, quality_metrics=None):
+        derived_from = {'derived_from_task': derived_from_task,
+                        'derived_from_filekey': derived_from_filekey}
+        if inputs:
+            derived_from['derived_from_inputs'] = 'true'
+        params = {'filekey': filekey,
+                  'output_type': output_type,
+                  'file_format': file_format,
+                  'derived_from_files': [derived_from]}
+        if quality_metrics:
+            params['quality_metrics'] = quality_metrics
+        return params
+
+    return [
+        step('align', 'bowtie2', [
+            wdl_file('bam', 'unfiltered alignments', 'bam',
+                     'trim_adapter', 'fastqs', inputs=True)]),
+        step('align', 'filter', [
+            wdl_file('nodup_bam', 'alignments', 'bam',
+                     'trim_adapter', 'fastqs', inputs=True,
+                     quality_metrics=['cross_correlation',
+                                      'samtools_flagstat'])]),
+        step('signal', 'macs2', [
+            wdl_file('sig_fc', 'fold change over control', 'bigWig',
+                     'filter', 'nodup_bam'),
+            wdl_file('sig_pval', 'signal p-value', 'bigWig',
+                     'filter', 'nodup_bam')]),
+        step('peaks', 'macs2', [
+            wdl_file('bfilt_npeak', 'peaks and background as input for IDR',
+                     'bed', 'filter', 'nodup_bam')]),
+        step('idr', 'reproducibility_idr', [
+            wdl_file('optimal_peak', 'optimal idr thresholded peaks', 'bed',
+                     'macs2', 'bfilt_npeak', quality_metrics=['idr'])]),
+        step('overlap', 'reproducibility_overlap', [
+            wdl_file('optimal_peak', 'replicated peaks', 'bed',
+                     'macs2', 'bfilt_npeak')])
+    ]
+
+
+def write_json(obj, directory, name):
+    file_path = os.path.join(directory, name)
+    with open(file_path, 'w') as json_file:
+        json.dump(obj, json_file)
+    return file_path
+
+
+class Benchmark(object):
+    """Runs the phases and collects time, memory and request counts"""
+    def __init__(self, portal, backend):
+        self.portal = portal
+        self.backend = backend
+        self.phases = {}
+
+    def run(self, name, function):
+        portal_requests = dict(self.portal.requests)
+        storage_requests = dict(self.backend.requests)
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        # Progress printed by accessioning goes to stderr, the report
+        # is the only thing written to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            result = function()
+        self.phases[name] = {
+            'seconds':              time.perf_counter() - start,
+            'peak_memory_bytes':    tracemalloc.get_traced_memory()[1],
+            'retained_memory_bytes':
+                tracemalloc.get_traced_memory()[0] - retained,
+            'portal_requests':      self.difference(self.portal.requests,
+                                                    portal_requests),
+            'storage_requests':     self.difference(self.backend.requests,
+                                                    storage_requests)
+        }
+        return result
+
+    def difference(self, after, before):
+        return {key: value - before.get(key, 0)
+                for key, value in sorted(after.items())
+                if value - before.get(key, 0)}
+
+
+# Bytes held by a GSFile itself and the containers only it refers to
+def file_footprint(file):
+    footprint = sys.getsizeof(file) + sys.getsizeof(file.filekeys)
+    if file.used_by_tasks:
+        footprint += sys.getsizeof(file.used_by_tasks)
+    if file.md5 is not None:
+        footprint += sys.getsizeof(file.md5)
+    return footprint
+
+
+def search_all(analysis):
+    found = 0
+    for task in analysis.tasks:
+        found += len(list(analysis.search_up(task, 'trim_adapter', 'fastqs',
+                                             True)))
+        found += len(list(analysis.search_down(task, 'xcor', 'plot_pdf')))
+    return found
+
+
+def derive_all(accessioner):
+    derived = 0
+    for step in accessioner.steps_and_params_json:
+        for task in accessioner.analysis.get_tasks(step['wdl_task_name']):
+            for file_params in step['wdl_files']:
+                for file in task.output_files:
+                    if file_params['filekey'] not in file.filekeys:
+                        continue
+                    derived += len(accessioner.get_derived_from_all(
+                        file, file_params['derived_from_files']))
+    return derived
+
+
+# The benchmark runs offline, anything reaching for the network fails it
+# rather than being measured
+def cut_off_network():
+    def refuse(*args, **kwargs):
+        raise OSError('Network access attempted by the offline benchmark')
+    socket.getaddrinfo = refuse
+    socket.socket.connect = refuse
+    socket.socket.connect_ex = refuse
+
+
+def main(args):
+    cut_off_network()
+    metadata = make_metadata(args.scatter_width, args.files_per_task,
+                             args.extra_tasks)
+    portal = FakePortal(args.portal_latency)
+    backend = MemoryBackend(make_files(metadata, args.scatter_width),
+                            args.storage_latency)
+    directory = tempfile.mkdtemp()
+    metadata_json = write_json(metadata, directory, 'metadata.json')
+    steps_json = write_json(make_steps(), directory, 'steps.json')
+    # Raw fastqs are already on the portal
+    for rep in range(1, args.scatter_width + 1):
+        for read in [1, 2]:
+            fastq = path('fastqs/rep{}_R{}.fastq.gz'.format(rep, read))
+            portal.add({'md5sum': hashlib.md5(backend.files[fastq]).hexdigest(),
+                        'dataset': '/experiments/ENCSR000BEN/',
+                        'biological_replicates': [rep],
+                        'status': 'released'})
+
+    profiler = Profiler() if args.profile else None
+    # Accessioning talks to the stand-ins only
+    shared = SharedState('benchmark', profiler, rate=args.portal_rate,
+                         connect=lambda server: portal)
+    shared.backends['mem'] = backend
+    shared.session.session.mount(portal.dcc_url, PortalAdapter(portal))
+    if profiler:
+        shared.instrument_backend(backend)
+    shared.current_user = '/users/benchmark/'
+
+    benchmark = Benchmark(portal, backend)
+    tracemalloc.start()
+    accessioner = benchmark.run('construct', lambda: Accession(
+        steps_json, metadata_json, 'dev', '/labs/benchmark/', 'U41HG000000',
+        metadata_workers=args.workers, shared=shared))
+    found = benchmark.run('search', lambda: search_all(accessioner.analysis))
+    benchmark.run('accession_steps',
+                  lambda: accessioner.accession_steps(args.workers))
+    derived = benchmark.run('get_derived_from',
+                            lambda: derive_all(accessioner))
+    tracemalloc.stop()
+    report = {
+        'parameters':   vars(args),
+        'tasks':        len(accessioner.analysis.tasks),
+        'files':        len(accessioner.analysis.files),
+        'bytes_per_file':       sum(map(file_footprint,
+                                        accessioner.analysis.files))
+                                / len(accessioner.analysis.files),
+        'construct_bytes_per_file':
+            benchmark.phases['construct']['retained_memory_bytes']
+            / len(accessioner.analysis.files),
+        'search_results':       found,
+        'derived_from_results': derived,
+        'phases':       benchmark.phases
+    }
+    if profiler:
+        report['profile'] = profiler.report()
+    json.dump(report, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline accessioning \
+                                                 benchmark")
+    parser.add_argument('--scatter-width',
+                        type=int,
+                        default=2,
+                        help='Number of replicates scattered over')
+    parser.add_argument('--files-per-task',
+                        type=int,
+                        default=0,
+                        help='Extra outputs added to every task')
+    parser.add_argument('--extra-tasks',
+                        type=int,
+                        default=0,
+                        help='Extra tasks chained after filter per replicate')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Workers used for metadata and accessioning')
+    parser.add_argument('--storage-latency',
+                        type=float,
+                        default=0,
+                        help='Seconds added to every storage request')
+    parser.add_argument('--portal-latency',
+                        type=float,
+                        default=0,
+                        help='Seconds added to every portal request')
+    parser.add_argument('--portal-rate',
+                        type=float,
+                        default=1e6,
+                        help='Portal requests per second allowed by the rate \
+                              limiter, practically unlimited by default')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Include the call profile of the run')
+    main(parser.parse_args())
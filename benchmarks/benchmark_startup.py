@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""Startup benchmark of the accession.py command line modes
+
+Runs every mode in fresh interpreters and reports the time to import the
+CLI and the time from launch to the first network request. It also reports
+which of the heavy packages were loaded by then. Network access is cut off
+in the runs: the first DNS lookup or connection ends the run before
+anything is sent.
+"""
+import argparse
+import importlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Packages whose import dominates startup, and the reason they are needed
+HEAVY_MODULES = ['encode_utils', 'requests', 'google.cloud.storage',
+                 'google.auth', 'ijson']
+
+BUCKET = 'benchmark-bucket'
+
+MODES = {
+    'help':         ['--help'],
+    'filter':       ['--filter-from-path',
+                     'gs://{}/atac/*/metadata.json'.format(BUCKET),
+                     '--output-dir', '{directory}/json_files'],
+    'accession':    ['--accession-steps', '{steps}',
+                     '--accession-metadata', '{metadata}',
+                     '--lab', '/labs/benchmark/',
+                     '--award', 'U41HG000000']
+}
+
+
+# Synthetic ATAC-seq metadata of the accessioning benchmark, with its
+# files in a GCS bucket
+def write_inputs(directory, scatter_width):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import benchmark_accession
+    metadata = json.dumps(
+        benchmark_accession.make_metadata(scatter_width, 0, 0)).replace(
+            benchmark_accession.ROOT, 'gs://{}/atac/'.format(BUCKET))
+    paths = {'directory': directory,
+             'metadata': os.path.join(directory, 'metadata.json'),
+             'steps': os.path.join(directory, 'steps.json')}
+    with open(paths['metadata'], 'w') as metadata_json:
+        metadata_json.write(metadata)
+    with open(paths['steps'], 'w') as steps_json:
+        json.dump(benchmark_accession.make_steps(), steps_json)
+    return paths
+
+
+# Runs that reached the network while importing have no import time, and
+# runs that never reached it have no first request time
+def median(runs, key):
+    values = [run[key] for run in runs if run[key] is not None]
+    return statistics.median(values) if values else None
+
+
+def run_mode(mode, paths, repeats):
+    cli_args = [arg.format(**paths) for arg in MODES[mode]]
+    runs = []
+    for _ in range(repeats):
+        report = os.path.join(paths['directory'], 'report.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__),
+                        '--child', json.dumps(cli_args),
+                        '--report', report,
+                        '--launched', repr(time.time())],
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=False)
+        with open(report) as report_json:
+            runs.append(json.load(report_json))
+        os.remove(report)
+    return {
+        'args':                 cli_args,
+        'import_seconds':       median(runs, 'import_seconds'),
+        'first_request_seconds': median(runs, 'first_request_seconds'),
+        'exit_seconds':         median(runs, 'exit_seconds'),
+        'first_request_host':   runs[-1]['first_request_host'],
+        'loaded_modules':       runs[-1]['loaded_modules']
+    }
+
+
+class Child(object):
+    """Runs the CLI once and writes when it first reached for the network"""
+    def __init__(self, report, launched):
+        self.report_path = report
+        self.launched = launched
+        self.report = {'import_seconds':         None,
+                       'first_request_seconds':  None,
+                       'first_request_host':     None,
+                       'exit_seconds':           None,
+                       'loaded_modules':         None}
+
+    def run(self, cli_args):
+        socket.getaddrinfo = self.first_request
+        socket.socket.connect = self.first_request
+        socket.socket.connect_ex = self.first_request
+        sys.path.insert(0, SRC)
+        start = time.perf_counter()
+        importlib.import_module('accession')
+        self.report['import_seconds'] = time.perf_counter() - start
+        sys.argv = [os.path.join(SRC, 'accession.py')] + cli_args
+        try:
+            import runpy
+            runpy.run_path(sys.argv[0], run_name='__main__')
+        except BaseException:
+            pass
+        self.finish()
+
+    # Requests may be made from worker threads, so the run is ended from
+    # here rather than by an exception
+    def first_request(self, *args, **kwargs):
+        host = args[0] if args and isinstance(args[0], str) else args[-1]
+        self.report['first_request_seconds'] = time.time() - self.launched
+        self.report['first_request_host'] = str(host)
+        self.finish()
+
+    def finish(self):
+        self.report['exit_seconds'] = time.time() - self.launched
+        self.report['loaded_modules'] = [name
+                                         for name in HEAVY_MODULES
+                                         if name in sys.modules]
+        with open(self.report_path, 'w') as report:
+            json.dump(self.report, report)
+        os._exit(0)
+
+
+def main(args):
+    directory = tempfile.mkdtemp()
+    paths = write_inputs(directory, args.scatter_width)
+    report = {'parameters':  vars(args),
+              'python':      sys.version.split()[0],
+              'modes':       {mode: run_mode(mode, paths, args.repeats)
+                              for mode in args.modes}}
+    json.dump(report, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Startup benchmark of the \
+                                                 accession.py modes")
+    parser.add_argument('--modes',
+                        nargs='+',
+                        choices=sorted(MODES),
+                        default=['help', 'filter', 'accession'],
+                        help='Command line modes measured')
+    parser.add_argument('--repeats',
+                        type=int,
+                        default=5,
+                        help='Fresh interpreters started per mode, medians \
+                              are reported')
+    parser.add_argument('--scatter-width',
+                        type=int,
+                        default=2,
+                        help='Number of replicates in the metadata of the \
+                              accession mode')
+    parser.add_argument('--child',
+                        type=str,
+                        default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--report',
+                        type=str,
+                        default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--launched',
+                        type=float,
+                        default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        Child(args.report, args.launched).run(json.loads(args.child))
+    else:
+        main(args)
@@ -0,0 +1,1123 @@
+"""Accessioning of the outputs of Cromwell workflows to the ENCODE portal"""
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from analysis import Analysis, JOURNAL_FILE_PROPERTIES
+from portal import (SharedState, Attachment, JsonBody, WriteQueue,
+                    PlanConnection)
+from storage_backends import METADATA_WORKERS
+
+
+COMMON_METADATA = {
+    'lab': '/labs/encode-processing-pipeline/',
+    'award': 'U41HG007000'
+}
+
+QC_MAP = {
+    'cross_correlation': 'attach_cross_correlation_qc_to',
+    'samtools_flagstat': 'attach_flagstat_qc_to',
+    'idr':               'attach_idr_qc_to'
+}
+
+# Portal types of the quality metric profiles posted
+QC_TYPES = {
+    'idr-quality-metrics':                  'IDRQualityMetric',
+    'samtools-flagstats-quality-metric':    'SamtoolsFlagstatsQualityMetric',
+    'complexity-xcorr-quality-metrics':     'ComplexityXcorrQualityMetric'
+}
+
+ASSEMBLIES = ['GRCh38', 'mm10']
+
+# File name suffix of the fingerprints of accessioned workflows, the
+# md5sums of the files every step accessioned
+FINGERPRINT_SUFFIX = '.fingerprint.json'
+
+# Number of workflows accessioned concurrently in batch mode
+WORKFLOW_WORKERS = 4
+
+# Number of md5sums resolved by a single portal search request
+PORTAL_SEARCH_BATCH = 50
+
+# File properties looked up to attach quality metrics
+QC_FILE_FIELDS = ['@id', 'accession', 'step_run', 'biological_replicates',
+                  'quality_metrics.@type']
+
+# Number of chunks buffered between download and upload when streaming
+STREAM_QUEUE_SIZE = 4
+
+
+class RunContext(object):
+    """Run-level values of a workflow, resolved on first use and cached"""
+    def __init__(self, accession):
+        self.accession = accession
+        self.shared = accession.shared
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def memoized(self, name, resolve):
+        if name not in self.values:
+            with self.lock:
+                if name not in self.values:
+                    self.values[name] = resolve()
+        return self.values[name]
+
+    @property
+    def assembly(self):
+        return self.memoized('assembly', self.resolve_assembly)
+
+    @property
+    def lab_pi(self):
+        return self.memoized('lab_pi', self.resolve_lab_pi)
+
+    @property
+    def dataset(self):
+        return self.memoized('dataset', self.resolve_dataset)
+
+    def resolve_assembly(self):
+        ref_fa = self.accession.analysis.get_tasks(
+            'read_genome_tsv')[0].outputs.get('genome', {}).get('ref_fa', '')
+        assembly = [reference
+                    for reference
+                    in ASSEMBLIES
+                    if reference
+                    in ref_fa]
+        return assembly[0] if len(assembly) > 0 else ''
+
+    def resolve_lab_pi(self):
+        return COMMON_METADATA['lab'].split('/labs/')[1].split('/')[0]
+
+    def resolve_dataset(self):
+        return self.accession.file_at_portal(
+            self.accession.analysis.raw_fastqs[0].filename).get('dataset')
+
+    # Step runs are shared by all workflows of a batch. Those missing from
+    # the cache and the journal are looked up on the portal by alias and
+    # only posted when the portal does not have them either
+    def step_run(self, lab_prefix, run_name, step_version, task_name):
+        docker_image = self.accession.analysis.get_tasks(
+            task_name)[0].docker_image
+        alias = "{}:{}-{}".format(lab_prefix, run_name,
+                                  docker_image.split(':')[1])
+        step_runs = self.shared.step_runs
+        if alias in step_runs:
+            return step_runs[alias]
+        with self.shared.step_run_lock(alias):
+            if alias not in step_runs:
+                step_runs[alias] = self.find_or_post_step_run(alias,
+                                                              step_version)
+        return step_runs[alias]
+
+    def find_or_post_step_run(self, alias, step_version):
+        journal = self.accession.journal
+        if journal and alias in journal.step_runs:
+            return journal.step_runs[alias]
+        conn = self.accession.conn
+        step_run = conn.get(alias, ignore404=True)
+        if not step_run:
+            payload = {'aliases': [alias],
+                       'status': 'released',
+                       'analysis_step_version': step_version}
+            payload[conn.PROFILE_KEY] = 'analysis_step_runs'
+            step_run = conn.post(payload)
+        if journal:
+            journal.record_step_run(alias, step_run)
+        return step_run
+
+
+class Accession(object):
+    """docstring for Accession"""
+
+    def __init__(self, steps, metadata_json, server, lab, award,
+                 metadata_workers=METADATA_WORKERS, stream_uploads=False,
+                 journal_dir=None, shared=None):
+        super(Accession, self).__init__()
+        self.set_lab_award(lab, award)
+        if shared is None:
+            shared = SharedState(server)
+        self.shared = shared
+        self.analysis = Analysis(metadata_json, metadata_workers, journal_dir,
+                                 shared.make_backend)
+        self.journal = self.analysis.journal
+        self.steps_and_params_json = self.file_to_json(steps)
+        self.backend = self.analysis.backend
+        self.conn = shared.conn
+        self.stream_uploads = stream_uploads
+        self.new_files = []
+        self.new_files_lock = threading.Lock()
+        # md5sums of the files posted, patched or found on the portal,
+        # keyed by step name
+        self.accessioned_md5sums = {}
+        # Exceptions of failed queued writes keyed by their descriptions
+        self.write_failures = {}
+        self.step_runs = shared.step_runs
+        self.portal_files = shared.portal_files
+        if self.journal:
+            self.portal_files.update(self.journal.files)
+        # Plans only read the journal, placeholders must not end up in it
+        self.planning = isinstance(self.conn, PlanConnection)
+        if self.planning and self.journal:
+            self.step_runs.update(self.journal.step_runs)
+            self.journal = None
+        self.run = RunContext(self)
+        self.changed_files = self.find_changed_files()
+        if shared.profiler:
+            self.instrument(shared.profiler)
+
+    # Files of steps the earlier run of the same fastqs did not accession
+    # with the same md5sum change the outputs of every task downstream of
+    # them. Returns the output files of those tasks, or None when there is
+    # no earlier run and all are accessioned. Steps added since the earlier
+    # run have no files accessioned by it.
+    def find_changed_files(self):
+        previous = self.analysis.previous_fingerprint(self.shared.previous_runs)
+        if previous is None:
+            return None
+        changed_tasks = {}
+        for step in self.steps_and_params_json:
+            accessioned = set(previous['steps'].get(self.step_name(step), []))
+            for file in self.step_files(step):
+                if file.md5sum not in accessioned:
+                    changed_tasks.update(
+                        dict.fromkeys(self.analysis.descendants[file.task]))
+        return {file: None
+                for task in changed_tasks
+                for file in task.output_files}
+
+    def is_changed(self, file):
+        return self.changed_files is None or file in self.changed_files
+
+    # Steps with files to accession, unchanged steps of incremental runs
+    # are skipped without any storage or portal requests
+    def pending_steps(self):
+        if self.changed_files is None:
+            return self.steps_and_params_json
+        return [step
+                for step
+                in self.steps_and_params_json
+                if any(self.is_changed(file)
+                       for file in self.step_files(step))]
+
+    # Failed writes fail the workflow once all steps are done, so that it
+    # is not fingerprinted as fully accessioned
+    def finish(self):
+        if self.write_failures:
+            raise Exception('{} portal writes failed'.format(
+                len(self.write_failures)))
+        self.write_fingerprint()
+
+    # Closes the journal, which is opened even when only planning
+    def close(self):
+        if self.analysis.journal:
+            self.analysis.journal.close()
+
+    def record_accessioned(self, single_step_params, gs_file):
+        with self.new_files_lock:
+            self.accessioned_md5sums.setdefault(
+                self.step_name(single_step_params), {})[gs_file.md5sum] = None
+
+    # Unchanged files of incremental runs were accessioned by the earlier
+    # run and are carried over
+    def fingerprint(self):
+        steps = {}
+        for step in self.steps_and_params_json:
+            md5sums = steps.setdefault(self.step_name(step), {})
+            md5sums.update(self.accessioned_md5sums.get(self.step_name(step),
+                                                        {}))
+            md5sums.update(dict.fromkeys(file.md5sum
+                                         for file in self.step_files(step)
+                                         if not self.is_changed(file)))
+        return {'workflow_id':  self.analysis.workflow_id,
+                'raw_fastqs':   sorted(file.md5sum
+                                       for file in self.analysis.raw_fastqs),
+                'steps':        {name: sorted(md5sums)
+                                 for name, md5sums in steps.items()
+                                 if md5sums}}
+
+    def write_fingerprint(self):
+        if self.shared.fingerprint_dir is None or self.planning:
+            return
+        path = os.path.join(self.shared.fingerprint_dir, '{}{}'.format(
+            self.analysis.workflow_id, FINGERPRINT_SUFFIX))
+        with open(path, 'w') as fingerprint:
+            json.dump(self.fingerprint(), fingerprint)
+
+    def instrument(self, profiler):
+        profiler.instrument(self, 'accession', ['start_step'],
+                            step_label=lambda args: self.step_name(args[0]))
+        profiler.instrument(self, 'accession', ['accession_task'],
+                            step_label=lambda args: self.step_name(args[1]))
+        profiler.instrument(self, 'accession', ['accession_file'],
+                            count_bytes={'accession_file':
+                                         lambda args, result: args[1].size})
+        profiler.instrument(self, 'qc', QC_MAP.values())
+
+    def step_name(self, single_step_params):
+        return '{}/{}'.format(single_step_params['dcc_step_run'],
+                              single_step_params['wdl_task_name'])
+
+    def set_lab_award(self, lab, award):
+        global COMMON_METADATA
+        COMMON_METADATA['lab'] = lab
+        COMMON_METADATA['award'] = award
+
+    # Only deleted or revoked files taken over need the current user, it
+    # is requested once per batch when first used
+    @property
+    def current_user(self):
+        with self.shared.lock:
+            if self.shared.current_user is None:
+                self.shared.current_user = self.get_current_user()
+        return self.shared.current_user
+
+    def get_current_user(self):
+        response = self.shared.session.request(
+            'GET', self.conn.dcc_url + '/session-properties',
+            auth=self.conn.auth)
+        if response.ok:
+            user = response.json().get('user')
+            if user:
+                return user.get('@id')
+            raise Exception('Authenticated user not found')
+        else:
+            raise Exception('Request to portal failed')
+
+    def file_to_json(self, file):
+        with open(file) as json_file:
+            json_obj = json.load(json_file)
+        return json_obj
+
+    def file_to_json(self, file):
+        with open(file) as json_file:
+            json_obj = json.load(json_file)
+        return json_obj
+
+    def file_to_json(self, file):
+        with open(file) as json_file:
+            json_obj = json.load(json_file)
+        return json_obj
+
+    def accession_fastqs(self):
+        pass
+
+    def wait_for_portal(self):
+        pass
+
+    # Uses the md5sum already held by GSFile when available
+    def file_md5sum(self, file):
+        gs_file = self.analysis.files_by_name.get(file)
+        if gs_file:
+            return gs_file.md5sum
+        return self.backend.md5sum(file)
+
+    def file_at_portal(self, file):
+        return self.files_at_portal([file])[0]
+
+    # Resolves portal objects of many files, searching for up to
+    # PORTAL_SEARCH_BATCH uncached md5sums per request. Searches return the
+    # JOURNAL_FILE_PROPERTIES read when accessioning, files not in the
+    # search index yet, like those posted moments ago, are fetched one by
+    # one from the database. Other workflows and tasks evict entries from
+    # the shared cache at any time, so the objects returned are collected
+    # as they are resolved.
+    def files_at_portal(self, files):
+        self.wait_for_portal()
+        md5sums = [self.file_md5sum(file) for file in files]
+        resolved = {}
+        missing = []
+        for md5sum in dict.fromkeys(md5sums):
+            try:
+                resolved[md5sum] = self.portal_files[md5sum]
+            except KeyError:
+                missing.append(md5sum)
+        for i in range(0, len(missing), PORTAL_SEARCH_BATCH):
+            batch = missing[i:i + PORTAL_SEARCH_BATCH]
+            search_param = [('md5sum', md5sum) for md5sum in batch]
+            search_param.append(('type', 'File'))
+            search_param.extend(('field', field)
+                                for field in JOURNAL_FILE_PROPERTIES)
+            found = {}
+            for encode_file in self.conn.search(search_param):
+                found.setdefault(encode_file.get('md5sum'), encode_file)
+            for md5sum in batch:
+                encode_file = found.get(md5sum) or self.conn.get(
+                    'md5:{}'.format(md5sum), database=True)
+                resolved[md5sum] = encode_file or None
+                self.cache_portal_file(md5sum, resolved[md5sum])
+        return [resolved[md5sum] for md5sum in md5sums]
+
+    # Files confirmed on the portal are journaled so a resumed run
+    # does not search for them again
+    def cache_portal_file(self, md5sum, encode_file):
+        self.portal_files[md5sum] = encode_file
+        if (self.journal and encode_file
+                and encode_file.get('status') not in ['deleted', 'revoked']):
+            self.journal.record_file(encode_file)
+
+    def raw_fastq_inputs(self, file):
+        if not file.task and 'fastqs' in file.filekeys:
+            yield file
+        if file.task:
+            for input_file in file.task.input_files:
+                yield from self.raw_fastq_inputs(input_file)
+
+    def raw_files_accessioned(self):
+        return all(self.files_at_portal([file.filename
+                                         for file
+                                         in self.analysis.raw_fastqs]))
+
+    # submitted_file_name is patched back to the storage path right after
+    # a post, and only then is the file journaled, as files found on the
+    # portal are skipped by reruns. Planned posts, like the others, are
+    # looked up again by md5sum so possible duplicates are skipped.
+    def accession_file(self, encode_file, gs_file, possible_duplicate=False):
+        file_exists = self.file_at_portal(gs_file.filename)
+        submitted_file_path = {'submitted_file_name': gs_file.filename}
+        if not file_exists and self.planning:
+            encode_file.update(submitted_file_path)
+            encode_posted_file = self.conn.post(
+                encode_file, possible_duplicate=possible_duplicate)
+            self.portal_files.pop(gs_file.md5sum, None)
+            self.add_new_file(encode_posted_file)
+            self.plan_file('post', gs_file, encode_posted_file)
+            return encode_posted_file
+        elif not file_exists and self.stream_uploads:
+            encode_file.update(submitted_file_path)
+            encode_posted_file = self.post_file_metadata(encode_file)
+            self.portal_files.pop(gs_file.md5sum, None)
+            if self.awaits_upload(encode_posted_file, gs_file):
+                self.stream_upload(encode_posted_file, gs_file)
+            self.add_new_file(encode_posted_file)
+            return encode_posted_file
+        elif not file_exists:
+            local_file = self.backend.download(gs_file.filename)[0]
+            encode_file['submitted_file_name'] = local_file
+            try:
+                encode_posted_file = self.conn.post(encode_file)
+            finally:
+                self.backend.release(gs_file.filename)
+            self.portal_files.pop(gs_file.md5sum, None)
+            encode_posted_file = self.patch_file(encode_posted_file,
+                                                 submitted_file_path)
+            self.add_new_file(encode_posted_file)
+            return encode_posted_file
+        elif (file_exists
+              and file_exists.get('status')
+              in ['deleted', 'revoked']):
+            encode_file.update(submitted_file_path)
+            # Update the file to current user
+            # TODO: Reverse this when duplicate md5sums are enabled
+            encode_file.update({'submitted_by': self.current_user})
+            encode_patched_file = self.patch_file(file_exists, encode_file)
+            self.add_new_file(encode_patched_file)
+            self.plan_file('patch', gs_file, encode_patched_file)
+            return encode_patched_file
+        self.plan_file('skip', gs_file, file_exists, encode_file)
+        return file_exists
+
+    # Records the outcome for a file in the plan being made. Skipped
+    # files show the derived_from they would have been posted with.
+    def plan_file(self, action, gs_file, encode_file, planned_file=None):
+        if not self.planning:
+            return
+        with self.conn.lock:
+            self.conn.files.append({
+                'workflow_id':  self.analysis.workflow_id,
+                'filename':     gs_file.filename,
+                'md5sum':       gs_file.md5sum,
+                'action':       action,
+                'accession':    encode_file.get('accession'),
+                'derived_from': (planned_file or encode_file).get(
+                    'derived_from', [])
+            })
+
+    # Posts a file object without the local upload Connection.post
+    # would run afterwards. A file posted before under the same alias is
+    # returned instead, as Connection.post does.
+    def post_file_metadata(self, encode_file):
+        payload = dict(encode_file)
+        payload.pop(self.conn.PROFILE_KEY, None)
+        response = self.shared.session.request(
+            'POST', self.conn.dcc_url + '/files/',
+            auth=self.conn.auth,
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'application/json'},
+            json=payload)
+        if response.status_code == 409:
+            existing_file = self.conn.get(payload.get('aliases', []))
+            if existing_file:
+                return existing_file
+        response.raise_for_status()
+        return response.json()['@graph'][0]
+
+    # Files returned for an existing alias are only uploaded to while they
+    # still wait for the contents of gs_file, Connection.post never
+    # uploads to them
+    def awaits_upload(self, encode_file, gs_file):
+        return (encode_file.get('status') == 'uploading'
+                and encode_file.get('md5sum') == gs_file.md5sum)
+
+    # Streams the file from storage to the upload target of the posted
+    # file object through aws s3 cp reading from stdin. Download overlaps
+    # with upload and at most STREAM_QUEUE_SIZE chunks are held in memory.
+    def stream_upload(self, encode_file, gs_file):
+        credentials = encode_file.get('upload_credentials')
+        if not credentials:
+            credentials = self.conn.regenerate_aws_upload_creds(
+                encode_file.get('accession'))
+        environment = dict(os.environ)
+        environment.update({
+            'AWS_ACCESS_KEY_ID':        credentials['access_key'],
+            'AWS_SECRET_ACCESS_KEY':    credentials['secret_key'],
+            'AWS_SESSION_TOKEN':        credentials['session_token']
+        })
+        upload = subprocess.Popen(['aws', 's3', 'cp', '-',
+                                   credentials['upload_url'],
+                                   '--expected-size', str(gs_file.size),
+                                   '--only-show-errors'],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE,
+                                  env=environment)
+        chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def download():
+            try:
+                for chunk in self.backend.stream(gs_file.filename):
+                    if not put(chunk):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        downloader = threading.Thread(target=download, daemon=True)
+        downloader.start()
+        md5 = hashlib.md5()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                md5.update(chunk)
+                upload.stdin.write(chunk)
+            # Abort before the upload completes if the streamed bytes
+            # do not match the blob
+            if md5.hexdigest() != gs_file.md5sum:
+                raise Exception('md5sum mismatch while streaming {}'.format(
+                    gs_file.filename))
+        except BaseException:
+            stopped.set()
+            upload.kill()
+            upload.communicate()
+            raise
+        stdout, stderr = upload.communicate()
+        if upload.returncode:
+            raise Exception('Failed to upload {}: {}'.format(
+                gs_file.filename, stderr.decode()))
+
+    def add_new_file(self, encode_file):
+        with self.new_files_lock:
+            self.new_files.append(encode_file)
+        if self.journal:
+            self.journal.record_file(encode_file)
+
+    def patch_file(self, encode_file, new_properties):
+        self.portal_files.pop(encode_file.get('md5sum'), None)
+        new_properties[self.conn.ENCID_KEY] = encode_file.get('accession')
+        return self.conn.patch(new_properties, extend_array_values=False)
+
+    def get_or_make_step_run(self, lab_prefix, run_name, step_version, task_name):
+        return self.run.step_run(lab_prefix, run_name, step_version, task_name)
+
+    @property
+    def assembly(self):
+        return self.run.assembly
+
+    @property
+    def lab_pi(self):
+        return self.run.lab_pi
+
+    @property
+    def dataset(self):
+        return self.run.dataset
+
+    def file_from_template(self,
+                           file,
+                           file_format,
+                           output_type,
+                           step_run,
+                           derived_from,
+                           dataset,
+                           file_format_type=None):
+        file_name = file.filename.split('://')[-1].strip('/').replace('/', '-')
+        obj = {
+            'status':               'uploading',
+            'aliases':              ['{}:{}'.format(self.lab_pi, file_name)],
+            'file_format':          file_format,
+            'output_type':          output_type,
+            'assembly':             self.assembly,
+            'dataset':              dataset,
+            'step_run':             step_run.get('@id'),
+            'derived_from':         derived_from,
+            'file_size':            file.size,
+            'md5sum':               file.md5sum
+        }
+        if file_format_type:
+            obj['file_format_type'] = file_format_type
+        obj[self.conn.PROFILE_KEY] = 'file'
+        obj.update(COMMON_METADATA)
+        return obj
+
+    def get_derived_from_all(self, file, files, inputs=False):
+        ancestors = []
+        for ancestor in files:
+            ancestors.append(
+                self.get_derived_from(file,
+                                      ancestor.get('derived_from_task'),
+                                      ancestor.get('derived_from_filekey'),
+                                      ancestor.get('derived_from_output_type'),
+                                      ancestor.get('derived_from_inputs')))
+        return list(self.flatten(ancestors))
+
+    def flatten(self, nested_list):
+        if isinstance(nested_list, str):
+            yield nested_list
+        if isinstance(nested_list, list):
+            for item in nested_list:
+                yield from self.flatten(item)
+
+    # Returns list of accession ids of files on portal or recently accessioned
+    def get_derived_from(self, file, task_name, filekey, output_type=None, inputs=False):
+        derived_from_files = list(self.analysis.search_up(file.task,
+                                                          task_name,
+                                                          filekey,
+                                                          inputs))
+        encode_files = self.files_at_portal([gs_file.filename
+                                             for gs_file
+                                             in derived_from_files])
+        with self.new_files_lock:
+            accessioned_files = encode_files + self.new_files
+        accessioned_files = [x for x in accessioned_files if x is not None]
+        derived_from_accession_ids = []
+        for gs_file in derived_from_files:
+            for encode_file in accessioned_files:
+                if gs_file.md5sum == encode_file.get('md5sum'):
+                    # Optimal peaks can be mistaken for conservative peaks
+                    # when their md5sum is the same
+                    if output_type and output_type != encode_file.get('output_type'):
+                        continue
+                    derived_from_accession_ids.append(encode_file.get('accession'))
+        derived_from_accession_ids = list(dict.fromkeys(
+            derived_from_accession_ids))
+
+        # Raise exception when some or all of the derived_from files
+        # are missing from the portal
+        if not derived_from_accession_ids:
+            raise Exception('Missing all of the derived_from files on the portal')
+        if len(derived_from_accession_ids) != len(derived_from_files):
+            raise Exception('Missing some of the derived_from files on the portal')
+        return ['/files/{}/'.format(accession_id)
+                for accession_id in derived_from_accession_ids]
+
+    # File object to be accessioned
+    # inputs=True will search for input fastqs in derived_from
+
+    def make_file_obj(self, file, file_format, output_type, step_run,
+                      derived_from_files, file_format_type=None, inputs=False):
+        derived_from = self.get_derived_from_all(file,
+                                                 derived_from_files,
+                                                 inputs)
+        return self.file_from_template(file,
+                                       file_format,
+                                       output_type,
+                                       step_run,
+                                       derived_from,
+                                       self.dataset,
+                                       file_format_type)
+
+    def get_bio_replicate(self, encode_file, string=True):
+        replicate = encode_file.get('biological_replicates')[0]
+        if string:
+            return str(replicate)
+        return int(replicate)
+
+    def attach_idr_qc_to(self, encode_file, gs_file):
+        if list(filter(lambda x: 'IDRQualityMetric'
+                                 in x['@type'],
+                       encode_file['quality_metrics'])):
+            return
+        qc = self.backend.read_json(self.analysis.get_files('qc_json')[0])
+        idr_qc = qc['idr_frip_qc']
+        replicate = self.get_bio_replicate(encode_file)
+        rep_pr = idr_qc['rep' + replicate + '-pr']
+        frip_score = rep_pr['FRiP']
+        idr_peaks = qc['ataqc']['rep' + replicate]['IDR peaks'][0]
+        step_run = encode_file.get('step_run')
+        if isinstance(step_run, str):
+            step_run_id = step_run
+        elif isinstance(step_run, dict):
+            step_run_id = step_run.get('@id')
+        qc_object = {}
+        qc_object['F1'] = frip_score
+        qc_object['N1'] = idr_peaks
+        idr_cutoff = self.analysis.metadata['inputs']['atac.idr_thresh']
+        # Strongly expects that plot exists
+        plot_png = next(self.analysis.search_up(gs_file.task,
+                                                'idr_pr',
+                                                'idr_plot'))
+        qc_object.update({
+            'step_run':                             step_run_id,
+            'quality_metric_of':                    [encode_file.get('@id')],
+            'IDR_cutoff':                           idr_cutoff,
+            'status':                               'released',
+            'IDR_plot_rep{}_pr'.format(replicate):  self.get_attachment(plot_png, 'image/png')})
+        qc_object.update(COMMON_METADATA)
+        qc_object[self.conn.PROFILE_KEY] = 'idr-quality-metrics'
+        posted_qc = self.post_quality_metric(qc_object)
+        return posted_qc
+
+    def attach_flagstat_qc_to(self, encode_bam_file, gs_file):
+        # Return early if qc metric exists
+        if list(filter(lambda x: 'SamtoolsFlagstatsQualityMetric'
+                                 in x['@type'],
+                       encode_bam_file['quality_metrics'])):
+            return
+        qc = self.backend.read_json(self.analysis.get_files('qc_json')[0])
+        replicate = self.get_bio_replicate(encode_bam_file)
+        flagstat_qc = qc['nodup_flagstat_qc']['rep' + replicate]
+        for key, value in flagstat_qc.items():
+            if '_pct' in key:
+                flagstat_qc[key] = '{}%'.format(value)
+        step_run = encode_bam_file.get('step_run')
+        if isinstance(step_run, str):
+            step_run_id = step_run
+        elif isinstance(step_run, dict):
+            step_run_id = step_run.get('@id')
+        flagstat_qc.update({
+            'step_run':             step_run_id,
+            'quality_metric_of':    [encode_bam_file.get('@id')],
+            'status':               'released'})
+        flagstat_qc.update(COMMON_METADATA)
+        flagstat_qc[self.conn.PROFILE_KEY] = 'samtools-flagstats-quality-metric'
+        posted_qc = self.post_quality_metric(flagstat_qc)
+        return posted_qc
+
+    def attach_cross_correlation_qc_to(self, encode_bam_file, gs_file):
+        # Return early if qc metric exists
+        if list(filter(lambda x: 'ComplexityXcorrQualityMetric'
+                                 in x['@type'],
+                       encode_bam_file['quality_metrics'])):
+            return
+
+        qc = self.backend.read_json(self.analysis.get_files('qc_json')[0])
+        plot_pdf = next(self.analysis.search_down(gs_file.task,
+                                                  'xcor',
+                                                  'plot_pdf'))
+        read_length_file = next(self.analysis.search_up(gs_file.task,
+                                                        'bowtie2',
+                                                        'read_len_log'))
+        read_length = int(self.backend.read_file(read_length_file.filename).decode())
+        replicate = self.get_bio_replicate(encode_bam_file)
+        xcor_qc = qc['xcor_score']['rep' + replicate]
+        pbc_qc = qc['pbc_qc']['rep' + replicate]
+        step_run = encode_bam_file.get('step_run')
+        if isinstance(step_run, str):
+            step_run_id = step_run
+        elif isinstance(step_run, dict):
+            step_run_id = step_run.get('@id')
+
+        xcor_object = {
+            'NRF':                  pbc_qc['NRF'],
+            'PBC1':                 pbc_qc['PBC1'],
+            'PBC2':                 pbc_qc['PBC2'],
+            'NSC':                  xcor_qc['NSC'],
+            'RSC':                  xcor_qc['RSC'],
+            'sample size':          xcor_qc['num_reads'],
+            "fragment length":      xcor_qc['est_frag_len'],
+            "quality_metric_of":    [encode_bam_file.get('@id')],
+            "step_run":             step_run_id,
+            "paired-end":           self.analysis.metadata['inputs']['atac.paired_end'],
+            "read length":          read_length,
+            "status":               "released",
+            "cross_correlation_plot": self.get_attachment(plot_pdf, 'application/pdf')
+        }
+
+        xcor_object.update(COMMON_METADATA)
+        xcor_object[self.conn.PROFILE_KEY] = 'complexity-xcorr-quality-metrics'
+        posted_qc = self.post_quality_metric(xcor_object)
+        return posted_qc
+
+    def file_has_qc(self, bam, qc):
+        for item in bam['quality_metrics']:
+            if item['@type'][0] == qc['@type'][0]:
+                return True
+        return False
+
+    def get_attachment(self, gs_file, mime_type):
+        return Attachment(self.backend, gs_file, mime_type)
+
+    # Posts a quality metric with its attachments streamed into the request
+    # body. When a quality metric of the same type, lab and award with
+    # attachments of the same md5sums and otherwise the same properties is
+    # on the portal, the files are added to the one there instead of
+    # uploading the attachments again.
+    def post_quality_metric(self, qc_object):
+        attachments = {key: value
+                       for key, value in qc_object.items()
+                       if isinstance(value, Attachment)}
+        if attachments:
+            existing_qc = self.quality_metric_with_attachments(qc_object,
+                                                               attachments)
+            if existing_qc:
+                return self.conn.patch({
+                    self.conn.ENCID_KEY:    existing_qc['@id'],
+                    'quality_metric_of':    qc_object['quality_metric_of']})
+        if self.planning or not attachments:
+            qc_object.update({key: attachment.as_dict()
+                              for key, attachment in attachments.items()})
+            return self.conn.post(qc_object, require_aliases=False)
+        payload = dict(qc_object)
+        profile = payload.pop(self.conn.PROFILE_KEY)
+        response = self.shared.session.request(
+            'POST', '{}/{}/'.format(self.conn.dcc_url, profile),
+            body=lambda: JsonBody(payload),
+            auth=self.conn.auth,
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'application/json'})
+        response.raise_for_status()
+        return response.json()['@graph'][0]
+
+    # Deleted and revoked quality metrics and those of other labs or
+    # awards are never reused. Lab and award are searched for by name.
+    def quality_metric_with_attachments(self, qc_object, attachments):
+        md5sums = [(key, attachment.md5sum)
+                   for key, attachment in attachments.items()]
+        if not all(md5sum for _, md5sum in md5sums):
+            return None
+        properties = [key
+                      for key in qc_object
+                      if key not in attachments
+                      and key not in ['quality_metric_of', 'lab', 'award',
+                                      self.conn.PROFILE_KEY]]
+        search_param = [('{}.md5sum'.format(key), md5sum)
+                        for key, md5sum in md5sums]
+        search_param.extend([
+            ('type', QC_TYPES[qc_object[self.conn.PROFILE_KEY]]),
+            ('status!', 'deleted'),
+            ('status!', 'revoked'),
+            ('lab.name', self.lab_pi),
+            ('award.name', COMMON_METADATA['award']),
+            ('field', '@id')])
+        search_param.extend(('field', key) for key in properties)
+        for existing_qc in self.conn.search(search_param):
+            if all(self.portal_value(existing_qc.get(key)) == qc_object[key]
+                   for key in properties):
+                return existing_qc
+        return None
+
+    # Linked objects like step_run may be embedded in search results
+    def portal_value(self, value):
+        if isinstance(value, dict) and '@id' in value:
+            return value['@id']
+        return value
+
+    # Output files of the step's tasks matching the step's filekeys
+    def step_files(self, single_step_params):
+        return [file
+                for task
+                in self.analysis.get_tasks(single_step_params['wdl_task_name'])
+                for file_params
+                in single_step_params['wdl_files']
+                for file
+                in task.output_files
+                if file_params['filekey'] in file.filekeys]
+
+    # Files the step's derived_from entries resolve to
+    def step_ancestor_files(self, single_step_params):
+        ancestors = set()
+        for file_params in single_step_params['wdl_files']:
+            for ancestor in file_params['derived_from_files']:
+                for task in self.analysis.get_tasks(
+                        ancestor.get('derived_from_task')):
+                    if ancestor.get('derived_from_inputs'):
+                        section = task.input_files
+                    else:
+                        section = task.output_files
+                    ancestors.update(
+                        file
+                        for file in section
+                        if ancestor.get('derived_from_filekey')
+                        in file.filekeys)
+        return ancestors
+
+    # Maps each step index to the indexes of earlier steps that accession
+    # any of its derived_from files
+    def step_dependencies(self, steps):
+        outputs = [set(self.step_files(step)) for step in steps]
+        dependencies = {}
+        for index, step in enumerate(steps):
+            ancestors = self.step_ancestor_files(step)
+            dependencies[index] = {earlier
+                                   for earlier
+                                   in range(index)
+                                   if outputs[earlier] & ancestors}
+        return dependencies
+
+    def start_step(self, single_step_params):
+        step_run = self.get_or_make_step_run(
+            self.lab_pi,
+            single_step_params['dcc_step_run'],
+            single_step_params['dcc_step_version'],
+            single_step_params['wdl_task_name'])
+        # Resolve existing portal objects of all files in the step at once
+        self.files_at_portal([file.filename
+                              for file
+                              in self.step_files(single_step_params)])
+        return step_run
+
+    def accession_step(self, single_step_params):
+        step_run = self.start_step(single_step_params)
+        write_queue = WriteQueue()
+        accessioned_files = []
+        for task in self.analysis.get_tasks(single_step_params['wdl_task_name']):
+            accessioned_files.extend(
+                self.accession_task(task, single_step_params, step_run,
+                                    write_queue))
+        self.flush_writes(write_queue)
+        return accessioned_files
+
+    # Quality metrics are queued on write_queue, those of a task without
+    # one are sent when the task is done
+    def accession_task(self, task, single_step_params, step_run,
+                       write_queue=None):
+        queue = write_queue if write_queue is not None else WriteQueue()
+        quality_metrics = {}
+        accessioned_files = []
+        for file_params in single_step_params['wdl_files']:
+            for wdl_file in [file
+                             for file
+                             in task.output_files
+                             if file_params['filekey']
+                             in file.filekeys
+                             and self.is_changed(file)]:
+
+                # Conservative IDR thresholded peaks may have
+                # the same md5sum as optimal one
+                try:
+                    obj = self.make_file_obj(wdl_file,
+                                             file_params['file_format'],
+                                             file_params['output_type'],
+                                             step_run,
+                                             file_params['derived_from_files'],
+                                             file_format_type=file_params.get('file_format_type'))
+                    encode_file = self.accession_file(
+                        obj, wdl_file,
+                        possible_duplicate=file_params.get(
+                            'possible_duplicate', False))
+                except Exception as e:
+                    if 'Conflict' in str(e) and file_params.get('possible_duplicate'):
+                        # The portal has a file with its md5sum
+                        self.record_accessioned(single_step_params, wdl_file)
+                        continue
+                    elif 'Missing all of the derived_from' in str(e):
+                        continue
+                    else:
+                        raise
+                self.record_accessioned(single_step_params, wdl_file)
+
+                # Files of possible duplicates may be the same portal
+                # file, its quality metrics are attached once
+                accession = encode_file.get('accession')
+                qcs = file_params.get('quality_metrics', [])
+                if not (self.journal and self.journal.has_quality_metrics(
+                        accession, qcs)):
+                    for qc in qcs:
+                        quality_metrics.setdefault((accession, qc), wdl_file)
+                accessioned_files.append(encode_file)
+        self.queue_quality_metrics(queue, quality_metrics)
+        if write_queue is None:
+            self.flush_writes(queue)
+        return accessioned_files
+
+    # Parameter file inputted assumes Accession implements the methods to
+    # attach the quality metrics. They are passed the encode files with
+    # calculated properties, looked up for all files at once.
+    def queue_quality_metrics(self, write_queue, quality_metrics):
+        encode_files = self.files_for_quality_metrics(
+            list(dict.fromkeys(accession
+                               for accession, _ in quality_metrics)))
+        for (accession, qc), gs_file in quality_metrics.items():
+            write_queue.add('{} of {}'.format(qc, accession),
+                            self.attach_quality_metric,
+                            qc,
+                            encode_files[accession],
+                            gs_file)
+
+    def attach_quality_metric(self, qc, encode_file, gs_file):
+        getattr(self, QC_MAP[qc])(encode_file, gs_file)
+        if self.journal:
+            self.journal.record_quality_metric(encode_file.get('accession'), qc)
+
+    # Searches for up to PORTAL_SEARCH_BATCH files per request, limited to
+    # QC_FILE_FIELDS. Searches leave out empty arrays, files without
+    # quality metrics get an empty list. Files not in the search index
+    # yet, like those posted moments ago, and files whose replicates are
+    # left out are fetched one by one.
+    def files_for_quality_metrics(self, accessions):
+        encode_files = {}
+        for i in range(0, len(accessions), PORTAL_SEARCH_BATCH):
+            search_param = [('accession', accession)
+                            for accession
+                            in accessions[i:i + PORTAL_SEARCH_BATCH]]
+            search_param.append(('type', 'File'))
+            search_param.extend(('field', field) for field in QC_FILE_FIELDS)
+            for encode_file in self.conn.search(search_param):
+                if 'biological_replicates' not in encode_file:
+                    continue
+                encode_file.setdefault('quality_metrics', [])
+                encode_files[encode_file.get('accession')] = encode_file
+        for accession in accessions:
+            if accession not in encode_files:
+                encode_files[accession] = self.conn.get(accession)
+        return encode_files
+
+    # Failed writes are reported as they happen and fail the workflow once
+    # all steps are done
+    def flush_writes(self, write_queue):
+        failures = write_queue.flush()
+        for description, e in failures.items():
+            print('Writing {} failed: {}'.format(description, e),
+                  file=sys.stderr)
+        with self.new_files_lock:
+            self.write_failures.update(failures)
+
+    def accession_steps(self, max_workers=1):
+        steps = self.pending_steps()
+        try:
+            if max_workers <= 1:
+                for step in steps:
+                    self.accession_step(step)
+            else:
+                self.accession_steps_concurrently(steps, max_workers)
+            self.finish()
+        finally:
+            self.close()
+
+    def accession_steps_concurrently(self, steps, max_workers):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            run_until_complete(self.schedule_steps(steps, executor))
+
+    # Steps run as soon as the steps accessioning their derived_from files
+    # have finished, and the tasks of running steps are accessioned
+    # concurrently. Files of a single task are accessioned in order, so
+    # possible duplicates are still detected. The portal and storage
+    # clients block, so their calls run on executor whose size bounds the
+    # operations in flight.
+    async def schedule_steps(self, steps, executor):
+        loop = asyncio.get_event_loop()
+        dependencies = self.step_dependencies(steps)
+        running = []
+
+        async def accession_step(index):
+            await asyncio.gather(*(running[earlier]
+                                   for earlier in dependencies[index]))
+            step_run = await loop.run_in_executor(executor, self.start_step,
+                                                  steps[index])
+            await asyncio.gather(*(
+                loop.run_in_executor(executor, self.accession_task, task,
+                                     steps[index], step_run)
+                for task
+                in self.analysis.get_tasks(steps[index]['wdl_task_name'])))
+
+        for index in range(len(steps)):
+            running.append(asyncio.ensure_future(accession_step(index)))
+        try:
+            await asyncio.gather(*running)
+        except BaseException:
+            # Steps waiting on a failed step are not started
+            for future in running:
+                future.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+
+
+# The image runs Python 3.6, which has no asyncio.run
+def run_until_complete(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+# Accessions many workflows in one process. Workflows run on a thread pool
+# and share the portal connection, storage backend, current user, step
+# runs and portal lookups. A failing workflow does not stop the others.
+def accession_batch(steps, metadata_jsons, server, lab, award,
+                    workflow_workers=WORKFLOW_WORKERS, accession_workers=1,
+                    shared=None, **kwargs):
+    if shared is None:
+        shared = SharedState(server)
+
+    def accession_workflow(metadata_json):
+        accessioner = Accession(steps, metadata_json, server, lab, award,
+                                shared=shared, **kwargs)
+        accessioner.accession_steps(accession_workers)
+
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workflow_workers) as executor:
+        futures = {executor.submit(accession_workflow, metadata_json):
+                   metadata_json
+                   for metadata_json in metadata_jsons}
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed[futures[future]] = e
+    raise_for_failures(failed, metadata_jsons)
+
+
+def raise_for_failures(failed, metadata_jsons):
+    for metadata_json, e in failed.items():
+        print('Accessioning {} failed: {}'.format(metadata_json, e),
+              file=sys.stderr)
+    if failed:
+        raise Exception('Accessioning failed for {} of {} workflows'.format(
+            len(failed), len(metadata_jsons)))
+
+
+# Fingerprints of earlier runs written to --fingerprint-dir. Metadata jsons
+# are not accepted as they do not tell which files were accessioned.
+def load_fingerprints(paths):
+    fingerprints = []
+    for path in paths:
+        if os.path.isdir(path):
+            fingerprint_paths = sorted(os.path.join(path, name)
+                                       for name in os.listdir(path)
+                                       if name.endswith(FINGERPRINT_SUFFIX))
+        elif path.endswith(FINGERPRINT_SUFFIX):
+            fingerprint_paths = [path]
+        else:
+            raise Exception('{} is not a fingerprint written with '
+                            '--fingerprint-dir'.format(path))
+        for fingerprint_path in fingerprint_paths:
+            with open(fingerprint_path) as fingerprint:
+                fingerprints.append(json.load(fingerprint))
+    return fingerprints
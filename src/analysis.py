@@ -0,0 +1,524 @@
+"""Tasks and files of a Cromwell workflow read from its metadata json"""
+import json
+import os
+import sys
+import threading
+from storage_backends import METADATA_WORKERS, backend_for
+# Optional, metadata jsons are parsed incrementally when available
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Properties of portal file objects kept in the run journal
+JOURNAL_FILE_PROPERTIES = ['@id', 'accession', 'md5sum', 'output_type',
+                           'status', 'dataset', 'biological_replicates']
+
+# Parts of Cromwell metadata used by Analysis. Inputs and outputs of
+# calls are pruned down to the file paths they contain.
+METADATA_SECTIONS = ['workflowRoot', 'inputs', 'outputs', 'labels']
+CALL_FIELDS = ['inputs', 'outputs', 'dockerImageUsed']
+
+
+class RunJournal(object):
+    """Append-only JSONL log of the completed work of one workflow"""
+    def __init__(self, journal_dir, workflow_id):
+        self.path = os.path.join(journal_dir, '{}.jsonl'.format(workflow_id))
+        self.lock = threading.Lock()
+        self.blobs = {}
+        # Compact portal file objects keyed by md5sum
+        self.files = {}
+        self.step_runs = {}
+        # Names of the QC_MAP entries attached to each file accession
+        self.quality_metrics = {}
+        if os.path.exists(self.path):
+            self.load()
+        self.log = open(self.path, 'a')
+
+    def load(self):
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be truncated by an interrupted run
+                    continue
+                self.apply(record)
+
+    def apply(self, record):
+        if record['type'] == 'blob':
+            self.blobs[record['filename']] = record['metadata']
+        elif record['type'] == 'file':
+            self.files[record['file']['md5sum']] = record['file']
+        elif record['type'] == 'step_run':
+            self.step_runs[record['alias']] = record['step_run']
+        elif record['type'] == 'quality_metric':
+            self.quality_metrics.setdefault(
+                record['accession'], set()).add(record['qc'])
+
+    def record(self, record):
+        with self.lock:
+            self.apply(record)
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    def record_blob(self, filename, metadata):
+        self.record({'type': 'blob', 'filename': filename, 'metadata': metadata})
+
+    def record_file(self, encode_file):
+        self.record({'type': 'file',
+                     'file': {key: encode_file[key]
+                              for key in JOURNAL_FILE_PROPERTIES
+                              if key in encode_file}})
+
+    def record_step_run(self, alias, step_run):
+        self.record({'type': 'step_run',
+                     'alias': alias,
+                     'step_run': {'@id': step_run.get('@id')}})
+
+    def record_quality_metric(self, accession, qc):
+        self.record({'type': 'quality_metric', 'accession': accession, 'qc': qc})
+
+    def has_quality_metrics(self, accession, qcs):
+        return set(qcs) <= self.quality_metrics.get(accession, set())
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+
+
+# Loads the parts of a Cromwell metadata json used by Analysis
+def load_metadata(metadata_json):
+    with open(metadata_json, 'rb') as json_file:
+        if ijson is None:
+            return prune_metadata(json.load(json_file))
+        return stream_metadata(json_file)
+
+
+def prune_metadata(metadata):
+    pruned = {key: metadata[key]
+              for key in METADATA_SECTIONS
+              if key in metadata}
+    if 'labels' in pruned:
+        pruned['labels'] = prune_labels(pruned['labels'])
+    pruned['calls'] = {}
+    for task_name, shards in metadata.get('calls', {}).items():
+        for shard in shards:
+            pruned['calls'].setdefault(task_name, []).append(
+                prune_call(shard))
+    return pruned
+
+
+def prune_call(shard):
+    pruned = {}
+    for key in CALL_FIELDS:
+        if key in shard:
+            store_call_field(pruned, key, shard[key])
+    return pruned
+
+
+def store_call_field(shard, key, value):
+    if key == 'dockerImageUsed':
+        shard[key] = value
+    else:
+        shard[key] = prune_files(value)
+
+
+def prune_labels(labels):
+    return {key: value
+            for key, value in labels.items()
+            if key == 'cromwell-workflow-id'}
+
+
+# Keeps the strings that may be file paths of any storage backend,
+# and the lists and dicts containing them
+def prune_files(value):
+    if isinstance(value, str):
+        return value if '://' in value or value.startswith('/') else None
+    if isinstance(value, list):
+        return [item
+                for item in map(prune_files, value)
+                if item is not None]
+    if isinstance(value, dict):
+        return {sys.intern(key): item
+                for key, item in ((key, prune_files(item))
+                                  for key, item in value.items())
+                if item is not None}
+    return None
+
+
+# Walks the parse events of the metadata json, building only the values
+# of METADATA_SECTIONS and of CALL_FIELDS of every call one at a time.
+# Keys of the enclosing maps, or 'item' inside arrays, are tracked instead
+# of ijson prefixes as task names contain dots.
+def stream_metadata(json_file):
+    metadata = {'calls': {}}
+    keys = []
+    builder = None
+    builder_path = None
+    shard = None
+    depth = 0
+    for event, value in ijson.basic_parse(json_file, use_float=True):
+        if builder:
+            builder.event(event, value)
+            if event in ['start_map', 'start_array']:
+                depth += 1
+            elif event in ['end_map', 'end_array']:
+                depth -= 1
+                if not depth:
+                    store_metadata_value(metadata, shard, builder_path,
+                                         builder.value)
+                    builder = None
+            continue
+        if event == 'map_key':
+            keys[-1] = value
+            continue
+        if event in ['end_map', 'end_array']:
+            keys.pop()
+            continue
+        path = tuple(keys)
+        if len(path) == 3 and path[0] == 'calls' and event == 'start_map':
+            shard = {}
+            metadata['calls'].setdefault(path[1], []).append(shard)
+        if ((len(path) == 1 and path[0] in METADATA_SECTIONS)
+                or (len(path) == 4 and path[0] == 'calls'
+                    and path[3] in CALL_FIELDS)):
+            if event in ['start_map', 'start_array']:
+                builder = ijson.ObjectBuilder()
+                builder_path = path
+                builder.event(event, value)
+                depth = 1
+            else:
+                store_metadata_value(metadata, shard, path, value)
+            continue
+        if event == 'start_map':
+            keys.append(None)
+        elif event == 'start_array':
+            keys.append('item')
+    return metadata
+
+
+def store_metadata_value(metadata, shard, path, value):
+    if len(path) == 4:
+        store_call_field(shard, path[3], value)
+    elif path[0] == 'labels':
+        metadata['labels'] = prune_labels(value)
+    else:
+        metadata[path[0]] = value
+
+
+class Analysis(object):
+    """docstring for Analysis"""
+    def __init__(self, metadata_json, max_workers=METADATA_WORKERS,
+                 journal_dir=None, make_backend=backend_for):
+        self.files = []
+        # Indexes over files and tasks, updated as files are added
+        self.files_by_name = {}
+        self.files_by_key = {}
+        self.tasks_by_name = {}
+        self.raw_fastq_files = {}
+        self.max_workers = max_workers
+        self.metadata = load_metadata(metadata_json)
+        # Loaded metadata always has calls, even when the json is empty
+        if self.metadata.get('workflowRoot'):
+            self.backend = make_backend(self.metadata['workflowRoot'])
+            self.journal = None
+            if journal_dir:
+                self.journal = RunJournal(journal_dir, self.workflow_id)
+            # A resumed run only stats files missing from the journal
+            if self.journal and self.journal.blobs:
+                self.backend.blob_metadata.update(self.journal.blobs)
+            else:
+                self.backend.cache_blob_metadata(self.metadata['workflowRoot'])
+            self.tasks = self.make_tasks()
+            self.build_task_graph()
+            if self.journal:
+                for file in self.files:
+                    if file.filename not in self.journal.blobs:
+                        self.journal.record_blob(
+                            file.filename,
+                            self.backend.get_blob_metadata(file.filename))
+        else:
+            raise Exception('Valid metadata json output must be supplied')
+
+    # Makes instances of Task
+    def make_tasks(self):
+        tasks = []
+        for key, value in self.metadata['calls'].items():
+            for task in value:
+                tasks.append(self.make_task(key, task))
+        # Resolve metadata of all unique files concurrently before
+        # wiring up tasks and files
+        filenames = set()
+        for task in tasks:
+            filenames.update(self.extract_files(task.outputs))
+            filenames.update(self.extract_files(task.inputs))
+        self.backend.prefetch_blob_metadata(filenames, self.max_workers)
+        for task in tasks:
+            self.tasks_by_name.setdefault(task.task_name, []).append(task)
+        for task in tasks:
+            task.output_files = self.get_or_make_files(task.outputs, task)
+        # Making input files after making output files avoids creating
+        # a duplicate file
+        for task in tasks:
+            task.input_files = self.get_or_make_files(task.inputs,
+                                                      used_by_tasks=task)
+        return tasks
+
+    # Makes an instance of task with input and output GSFile instances
+    def make_task(self, task_name, task):
+        new_task = Task(task_name.split('.')[1], task, self)
+        return new_task
+
+    # Makes instances of GSFile from input or output section of task
+    # When task=None, file is not associated with a task
+    def get_or_make_files(self, section, task=None, used_by_tasks=None):
+        files = []
+        for key, value in section.items():
+            for filename in self.extract_files(value):
+                files.append(self.get_or_make_file(key,
+                                                   filename,
+                                                   task,
+                                                   used_by_tasks))
+        return files
+
+    # Returns a GSFile object, makes a new one if one doesn't exist
+    def get_or_make_file(self, key, filename, task=None, used_by_tasks=None):
+        file = self.files_by_name.get(filename)
+        if file:
+            if file.add_filekey(key):
+                self.index_filekey(file, key)
+            if used_by_tasks:
+                file.add_used_by_task(used_by_tasks)
+            return file
+        md5sum = self.backend.md5sum(filename)
+        size = self.backend.size(filename)
+        new_file = GSFile(key, filename, md5sum, size, task, used_by_tasks)
+        self.files.append(new_file)
+        self.files_by_name[filename] = new_file
+        self.index_filekey(new_file, key)
+        return new_file
+
+    # Dicts keep insertion order and serve as ordered sets of files
+    def index_filekey(self, file, key):
+        self.files_by_key.setdefault(key, {})[file] = None
+        if key == 'fastqs' and file.task is None:
+            self.raw_fastq_files[file] = None
+
+    # Cromwell workflow id
+    @property
+    def workflow_id(self):
+        return self.metadata['labels']['cromwell-workflow-id']
+
+    # Files in the 'outputs' of the metadata that are
+    # used for filtering out intermediate outputs
+    @property
+    def outputs_whitelist(self):
+        return list(self.extract_files(self.metadata['outputs']))
+
+    # Files in the 'inputs' of the metadata that are
+    # used for filtering out intermediate inputs
+    @property
+    def inputs_whitelist(self):
+        return list(self.extract_files(self.metadata['inputs']))
+
+    # Extracts file names from dict values
+    def extract_files(self, outputs):
+        if self.backend.is_file(outputs):
+            yield outputs
+        elif isinstance(outputs, list):
+            for item in outputs:
+                yield from self.extract_files(item)
+        elif isinstance(outputs, dict):
+            for key, values in outputs.items():
+                yield from self.extract_files(values)
+
+    def get_tasks(self, task_name):
+        return list(self.tasks_by_name.get(task_name, []))
+
+    def get_files(self, filekey=None, filename=None):
+        files = {}
+        if filekey:
+            files.update(self.files_by_key.get(filekey, {}))
+        if filename and filename in self.files_by_name:
+            files[self.files_by_name[filename]] = None
+        return list(files)
+
+    @property
+    def raw_fastqs(self):
+        return list(self.raw_fastq_files)
+
+    # Builds the task graph once: adjacency lists, a topological order
+    # and the deduplicated ancestors and descendants of every task
+    def build_task_graph(self):
+        self.upstream_tasks = {}
+        self.downstream_tasks = {}
+        for task in self.tasks:
+            self.upstream_tasks[task] = list(dict.fromkeys(
+                file.task for file in task.input_files if file.task))
+            self.downstream_tasks[task] = list(dict.fromkeys(
+                used_by_task
+                for file in task.output_files
+                for used_by_task in file.used_by_tasks))
+        self.topological_order = self.sort_tasks()
+        # Tasks are ordered by depth first traversal starting from the task
+        # itself, matching the order of the former recursive search
+        self.ancestors = {}
+        for task in self.topological_order:
+            self.ancestors[task] = self.merge_tasks(task,
+                                                    self.upstream_tasks[task],
+                                                    self.ancestors)
+        self.descendants = {}
+        for task in reversed(self.topological_order):
+            self.descendants[task] = self.merge_tasks(
+                task,
+                self.downstream_tasks[task],
+                self.descendants)
+        self.search_cache = {}
+
+    # Kahn's algorithm, ties are broken by the order of self.tasks
+    def sort_tasks(self):
+        in_degree = {task: len(self.upstream_tasks[task])
+                     for task in self.tasks}
+        ready = [task for task in self.tasks if not in_degree[task]]
+        order = []
+        while ready:
+            task = ready.pop(0)
+            order.append(task)
+            for child in self.downstream_tasks[task]:
+                in_degree[child] -= 1
+                if not in_degree[child]:
+                    ready.append(child)
+        if len(order) != len(self.tasks):
+            raise Exception('Task graph in the metadata contains a cycle')
+        return order
+
+    def merge_tasks(self, task, neighbours, reachable):
+        merged = {task: None}
+        for neighbour in neighbours:
+            merged.update(dict.fromkeys(reachable[neighbour]))
+        return tuple(merged)
+
+    # Returns deduplicated files matching filekey from the input or output
+    # files of the tasks named task_name, results are memoized
+    def search_tasks(self, tasks, key, task_name, filekey, inputs=False):
+        if key not in self.search_cache:
+            files = {}
+            for task in tasks:
+                if task_name != task.task_name:
+                    continue
+                section = task.input_files if inputs else task.output_files
+                for file in section:
+                    if filekey in file.filekeys:
+                        files[file] = None
+            self.search_cache[key] = tuple(files)
+        return self.search_cache[key]
+
+    # Fingerprint of the last earlier run of the same raw fastqs
+    def previous_fingerprint(self, fingerprints):
+        fastqs = sorted(file.md5sum for file in self.raw_fastqs)
+        matching = [fingerprint
+                    for fingerprint
+                    in fingerprints
+                    if fingerprint['workflow_id'] != self.workflow_id
+                    and fingerprint.get('raw_fastqs') == fastqs]
+        return matching[-1] if matching else None
+
+    # Search the Analysis hirearchy up for a file matching filekey
+    # Returns generator object, access with next() or list()
+    def search_up(self, task, task_name, filekey, inputs=False):
+        yield from self.search_tasks(self.ancestors[task],
+                                     ('up', task, task_name, filekey,
+                                      bool(inputs)),
+                                     task_name,
+                                     filekey,
+                                     inputs)
+
+    # Search the Analysis hirearchy down for a file matching filekey
+    # Returns generator object, access with next()
+    def search_down(self, task, task_name, filekey):
+        yield from self.search_tasks(self.descendants[task],
+                                     ('down', task, task_name, filekey),
+                                     task_name,
+                                     filekey)
+
+
+class Task(object):
+    """docstring for Task"""
+    __slots__ = ['task_name', 'input_files', 'output_files', 'inputs',
+                 'outputs', 'docker_image', 'analysis']
+
+    def __init__(self, task_name, task, analysis):
+        super().__init__()
+        self.task_name = sys.intern(task_name)
+        self.input_files = []
+        self.output_files = []
+        self.inputs = task['inputs']
+        self.outputs = task['outputs']
+        self.docker_image = task.get('dockerImageUsed', None)
+        self.analysis = analysis
+
+
+class GSFile(object):
+    """docstring for File"""
+    # md5sum is held as 16 raw bytes and filekeys, interned, in a tuple as
+    # files rarely have more than two. used_by_tasks becomes a dict serving
+    # as an ordered set once a task uses the file, as shared inputs may be
+    # used by every shard of a scatter.
+    __slots__ = ['filename', 'filekeys', 'task', 'used_by_tasks', 'md5',
+                 'size']
+
+    def __init__(self, key, name, md5sum, size, task=None, used_by_tasks=None):
+        super().__init__()
+        self.filename = name
+        self.filekeys = (sys.intern(key),)
+        self.task = task
+        self.used_by_tasks = ()
+        if used_by_tasks:
+            self.add_used_by_task(used_by_tasks)
+        self.md5sum = md5sum
+        self.size = size
+
+    @property
+    def md5sum(self):
+        return self.md5.hex() if self.md5 is not None else None
+
+    @md5sum.setter
+    def md5sum(self, md5sum):
+        self.md5 = bytes.fromhex(md5sum) if md5sum is not None else None
+
+    # Returns True when key is new to the file
+    def add_filekey(self, key):
+        if key in self.filekeys:
+            return False
+        self.filekeys += (sys.intern(key),)
+        return True
+
+    def add_used_by_task(self, task):
+        if not self.used_by_tasks:
+            self.used_by_tasks = {}
+        self.used_by_tasks[task] = None
+
+    # Depends on all other tasks and files having finished initializing
+    # Returns lisf of files
+    def derived_from(self, filekey=None):
+        if not filekey:
+            return self.task.input_files
+        else:
+            return list(filter(lambda x: filekey in x.filekeys,
+                               self.task.input_files))
+
+
+# Expands directories in paths to the json files they contain
+def metadata_json_paths(paths):
+    metadata_jsons = []
+    for path in paths:
+        if os.path.isdir(path):
+            metadata_jsons.extend(sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.endswith('.json')))
+        else:
+            metadata_jsons.append(path)
+    return metadata_jsons
@@ -0,0 +1,555 @@
+"""Requests to the ENCODE portal and the state shared by accessioning runs"""
+import copy
+import functools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from base64 import b64encode
+from profiler import json_size
+from storage_backends import backend_for
+
+
+# Connections kept alive to the portal and the sustained rate of portal
+# requests per second, which is halved whenever the portal throttles us
+PORTAL_POOL_SIZE = 16
+PORTAL_RATE = 10
+PORTAL_MIN_RATE = 0.5
+
+# Retries of idempotent portal requests failing with one of RETRY_STATUSES
+# or a connection error, with jittered exponential backoff in seconds
+PORTAL_RETRIES = 5
+PORTAL_BACKOFF = 0.5
+PORTAL_MAX_BACKOFF = 30
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Number of queued quality metric and patch writes sent concurrently
+WRITE_WORKERS = 8
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of portal requests
+
+    The rate is halved on every throttled response, down to PORTAL_MIN_RATE,
+    and grows back by a fiftieth of the configured rate with every
+    successful request.
+    """
+    def __init__(self, rate=PORTAL_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes a token, waiting until one is available. Tokens may go
+    # negative so concurrent callers queue up behind each other.
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens
+                              + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.rate = max(PORTAL_MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            if retry_after:
+                self.tokens = min(self.tokens, -retry_after * self.rate)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class PortalSession(object):
+    """Pooled keep-alive HTTP session to the portal
+
+    Requests are rate limited by a shared RateLimiter. Idempotent requests
+    are retried on connection errors and RETRY_STATUSES, others only when
+    throttled as the portal has not processed them.
+    """
+    def __init__(self, pool_size=PORTAL_POOL_SIZE, rate=PORTAL_RATE):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = RateLimiter(rate)
+
+    # body, when given, is called for the data of every attempt so that
+    # streamed request bodies can be sent again
+    def request(self, method, url, body=None, **kwargs):
+        def send():
+            if body is not None:
+                kwargs['data'] = body()
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code in RETRY_STATUSES:
+                response.raise_for_status()
+            return response
+        return self.retrying(send, method in ['GET', 'HEAD'])()
+
+    # Rate limits and retries the requests of the Connection methods,
+    # which are sent over the session by make_connection
+    def wrap(self, conn):
+        conn.get = self.retrying(conn.get, True)
+        conn.search = self.retrying(conn.search, True)
+        conn.post = self.retrying(conn.post, False)
+        conn.patch = self.retrying(conn.patch, False)
+
+    def retrying(self, function, idempotent):
+        from requests.exceptions import RequestException
+
+        def wrapper(*args, **kwargs):
+            for attempt in range(PORTAL_RETRIES + 1):
+                self.limiter.acquire()
+                try:
+                    result = function(*args, **kwargs)
+                except RequestException as e:
+                    response = e.response
+                    status = getattr(response, 'status_code', None)
+                    if status == 429:
+                        self.limiter.throttled(self.retry_after(response))
+                    elif not idempotent or (status and status < 500):
+                        raise
+                    if attempt == PORTAL_RETRIES:
+                        raise
+                    time.sleep(random.uniform(
+                        0, min(PORTAL_MAX_BACKOFF, PORTAL_BACKOFF * 2 ** attempt)))
+                    continue
+                self.limiter.succeeded()
+                return result
+        return wrapper
+
+    def retry_after(self, response):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
+
+
+class SessionRequests(object):
+    """Stand-in for the requests module sending requests over a session
+
+    Other attributes, like codes and exceptions, are those of requests.
+    """
+    METHODS = ['request', 'get', 'head', 'options', 'post', 'put', 'patch',
+               'delete']
+
+    def __init__(self, session):
+        import requests
+        self.requests = requests
+        self.session = session
+
+    def __getattr__(self, name):
+        if name in self.METHODS:
+            return getattr(self.session, name)
+        return getattr(self.requests, name)
+
+
+# encode_utils fetches the portal profiles when it is imported, so it is
+# only imported once a connection is made. Connection sends its requests
+# with the functions of the requests module imported by
+# encode_utils.connection, which are routed through session so they reuse
+# its pooled keep-alive connections.
+def make_connection(server, session):
+    from encode_utils import connection
+    connection.requests = SessionRequests(session)
+    return connection.Connection(server)
+
+
+class SharedState(object):
+    """Clients and caches shared by the Accession instances of a batch
+
+    The portal connection and session are made on first use. When planning
+    the connection is wrapped in a PlanConnection.
+    """
+    def __init__(self, server, profiler=None, pool_size=PORTAL_POOL_SIZE,
+                 rate=PORTAL_RATE, connect=None):
+        self.server = server
+        self.profiler = profiler
+        self.pool_size = pool_size
+        self.rate = rate
+        self.connect = connect or (
+            lambda server: make_connection(server, self.session.session))
+        self.planning = False
+        self.portal_conn = None
+        self.portal_session = None
+        self.client_lock = threading.RLock()
+        self.backends = {}
+        # slice_size and download_workers of GCBackend
+        self.download_options = {}
+        self.current_user = None
+        # Step runs keyed by alias, with a lock per alias so that concurrent
+        # workflows look up or post each step run once
+        self.step_runs = {}
+        self.step_run_locks = {}
+        # Portal file objects, or None when missing, keyed by md5sum
+        self.portal_files = {}
+        # Fingerprints of earlier runs, incremental runs only accession what
+        # changed since the earlier run of the same fastqs
+        self.previous_runs = []
+        # Directory the fingerprints of accessioned workflows are written to
+        self.fingerprint_dir = None
+        self.lock = threading.Lock()
+
+    @property
+    def conn(self):
+        with self.client_lock:
+            if self.portal_conn is None:
+                conn = self.connect(self.server)
+                self.session.wrap(conn)
+                if self.profiler:
+                    self.instrument_conn(conn)
+                if self.planning:
+                    conn = PlanConnection(conn)
+                self.portal_conn = conn
+        return self.portal_conn
+
+    @conn.setter
+    def conn(self, conn):
+        with self.client_lock:
+            self.portal_conn = conn
+
+    @property
+    def session(self):
+        with self.client_lock:
+            if self.portal_session is None:
+                self.portal_session = PortalSession(self.pool_size, self.rate)
+        return self.portal_session
+
+    def instrument_conn(self, conn):
+        self.profiler.instrument(
+            conn, 'portal', ['get', 'search', 'post', 'patch'],
+            count_bytes={
+                'get':      lambda args, result: json_size(result),
+                'search':   lambda args, result: json_size(result),
+                'post':     lambda args, result: json_size(args[0]),
+                'patch':    lambda args, result: json_size(args[0])
+            })
+
+    # Single storage backend per URI scheme for all workflows, it caches
+    # bucket handles and blob metadata of every file it is asked about
+    def make_backend(self, workflow_root):
+        scheme = workflow_root.split('://')[0] if '://' in workflow_root else ''
+        with self.lock:
+            if scheme not in self.backends:
+                self.backends[scheme] = backend_for(workflow_root,
+                                                    **self.download_options)
+                if self.profiler:
+                    self.instrument_backend(self.backends[scheme])
+        return self.backends[scheme]
+
+    def step_run_lock(self, alias):
+        with self.lock:
+            return self.step_run_locks.setdefault(alias, threading.Lock())
+
+    def instrument_backend(self, backend):
+        self.profiler.instrument(
+            backend, 'storage',
+            ['get_blob_metadata', 'list', 'stream', 'read_file', 'read_json',
+             'download'],
+            count_bytes={
+                'read_file':    lambda args, result: len(result),
+                'download':     lambda args, result: os.path.getsize(result[0])
+            })
+
+
+class Attachment(object):
+    """Attachment of a quality metric streamed from storage
+
+    The file is base64 encoded chunk by chunk into the data URI of the
+    request body, it is never held in memory as a whole.
+    """
+    def __init__(self, backend, gs_file, mime_type):
+        self.backend = backend
+        self.filename = gs_file.filename
+        self.size = gs_file.size
+        self.mime_type = mime_type
+
+    @property
+    def md5sum(self):
+        return self.backend.md5sum(self.filename)
+
+    # Serialized json around the base64 encoded file
+    def header(self):
+        return (json.dumps({'type': self.mime_type,
+                            'download': self.filename.split('/')[-1]}
+                           )[:-1].encode()
+                + ', "href": "data:{};base64,'.format(self.mime_type).encode())
+
+    # Number of bytes chunks yields, known before the file is read
+    def __len__(self):
+        return len(self.header()) + 4 * ((self.size + 2) // 3) + len(b'"}')
+
+    # Yields the attachment serialized as json
+    def chunks(self):
+        yield self.header()
+        yield from self.base64_chunks()
+        yield b'"}'
+
+    # Encodes whole groups of 3 bytes of every chunk, bytes left over
+    # are completed from the start of the next chunk
+    def base64_chunks(self):
+        remainder = b''
+        for chunk in self.backend.stream(self.filename):
+            chunk = memoryview(chunk)
+            if remainder:
+                needed = 3 - len(remainder)
+                if len(chunk) < needed:
+                    remainder += chunk.tobytes()
+                    continue
+                yield b64encode(remainder + chunk[:needed].tobytes())
+                chunk = chunk[needed:]
+            end = len(chunk) - len(chunk) % 3
+            yield b64encode(chunk[:end])
+            remainder = chunk[end:].tobytes()
+        yield b64encode(remainder)
+
+    # The attachment as a dict with the whole data URI
+    def as_dict(self):
+        return json.loads(b''.join(self.chunks()))
+
+
+class JsonBody(object):
+    """Payload serialized as json with its Attachment values streamed
+
+    Its length is known up front, so requests sends it with a
+    Content-Length rather than chunked, which front ends of the portal
+    may reject. Every iteration streams the attachments again.
+    """
+    def __init__(self, payload):
+        token = uuid.uuid4().hex
+        attachments = []
+
+        def default(value):
+            if isinstance(value, Attachment):
+                attachments.append(value)
+                return '{}-{}'.format(token, len(attachments) - 1)
+            raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+        parts = re.split('"{}-(\\d+)"'.format(token),
+                         json.dumps(payload, default=default))
+        # Serialized json and the attachments in between
+        self.parts = [parts[0].encode()]
+        for index in range(1, len(parts), 2):
+            self.parts.append(attachments[int(parts[index])])
+            self.parts.append(parts[index + 1].encode())
+
+    def __len__(self):
+        return sum(map(len, self.parts))
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, Attachment):
+                yield from part.chunks()
+            else:
+                yield part
+
+
+class WriteQueue(object):
+    """Portal writes collected while accessioning a step and sent together"""
+    def __init__(self, max_workers=WRITE_WORKERS):
+        self.max_workers = max_workers
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def add(self, description, write, *args):
+        with self.lock:
+            self.writes.append((description, functools.partial(write, *args)))
+
+    # Sends the queued writes with at most max_workers in flight. A failing
+    # write does not stop the others, failures are returned keyed by the
+    # descriptions of the writes.
+    def flush(self):
+        with self.lock:
+            writes, self.writes = self.writes, []
+        failures = {}
+        if not writes:
+            return failures
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(write): description
+                       for description, write in writes}
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[futures[future]] = e
+        return failures
+
+
+class PlanConnection(object):
+    """Read-only stand-in for Connection recording writes in a plan
+
+    Lookups go to the portal. Posted objects are simulated: files get
+    their first alias as placeholder accession and /files/<alias>/ as
+    placeholder @id, other objects their first alias as @id, so objects
+    derived from them can be planned before they exist. Biological
+    replicates of simulated files are those of their derived_from files.
+    Simulated files are also found by md5:<md5sum> like files on the
+    portal, and a second file with the same md5sum fails to post with a
+    Conflict.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        # Writes in an order they can be applied in
+        self.operations = []
+        # Outcome for every file accessioned
+        self.files = []
+        # Simulated objects keyed by their placeholder @id and accession
+        self.simulated = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def get(self, rec_ids, *args, **kwargs):
+        for rec_id in [rec_ids] if isinstance(rec_ids, str) else rec_ids:
+            if rec_id in self.simulated:
+                return copy.deepcopy(self.simulated[rec_id])
+        return self.conn.get(rec_ids, *args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        return self.conn.search(*args, **kwargs)
+
+    # Conflicts of files posted with possible_duplicate are skipped when
+    # the plan is applied, as they are when accessioning
+    def post(self, payload, require_aliases=True, possible_duplicate=False):
+        payload = copy.deepcopy(payload)
+        operation = {'method':          'post',
+                     'payload':         payload,
+                     'require_aliases': require_aliases}
+        simulated = {key: value
+                     for key, value in payload.items()
+                     if key != self.conn.PROFILE_KEY}
+        aliases = payload.get('aliases')
+        md5_id = None
+        if aliases and payload.get(self.conn.PROFILE_KEY) == 'file':
+            md5_id = 'md5:{}'.format(payload.get('md5sum'))
+            # Posted with a local copy of submitted_file_name uploaded
+            operation['upload'] = True
+            if possible_duplicate:
+                operation['possible_duplicate'] = True
+            simulated.update({
+                'accession':                aliases[0],
+                '@id':                      '/files/{}/'.format(aliases[0]),
+                'quality_metrics':          [],
+                'biological_replicates':    self.derived_replicates(payload)
+            })
+            operation['placeholders'] = {simulated['@id']: '@id',
+                                         aliases[0]: 'accession'}
+        elif aliases:
+            simulated['@id'] = aliases[0]
+            operation['placeholders'] = {aliases[0]: '@id'}
+        with self.lock:
+            if md5_id in self.simulated:
+                raise Exception('409 Client Error: Conflict, a file with '
+                                'md5sum {} is already planned to be '
+                                'posted'.format(payload['md5sum']))
+            self.operations.append(operation)
+            for placeholder in operation.get('placeholders', []):
+                self.simulated[placeholder] = simulated
+            if md5_id:
+                self.simulated[md5_id] = simulated
+        return copy.deepcopy(simulated)
+
+    def derived_replicates(self, payload):
+        replicates = set()
+        for file_id in payload.get('derived_from', []):
+            replicates.update(self.get(file_id).get('biological_replicates',
+                                                    []))
+        return sorted(replicates)
+
+    def patch(self, payload, raise_403=True, extend_array_values=True):
+        payload = copy.deepcopy(payload)
+        target = payload[self.conn.ENCID_KEY]
+        with self.lock:
+            self.operations.append({
+                'method':               'patch',
+                'payload':              payload,
+                'extend_array_values':  extend_array_values
+            })
+        patched = self.get(target)
+        for key, value in payload.items():
+            if key == self.conn.ENCID_KEY:
+                continue
+            if extend_array_values and isinstance(value, list):
+                value = list(dict.fromkeys(patched.get(key, []) + value))
+            patched[key] = value
+        return patched
+
+    def write(self, plan_json):
+        with open(plan_json, 'w') as plan_file:
+            json.dump({'operations': self.operations, 'files': self.files},
+                      plan_file, indent=4)
+
+
+# Replaces placeholders anywhere in value with the identifiers of the
+# objects they stand for
+def resolve_placeholders(value, identifiers):
+    if isinstance(value, str):
+        return identifiers.get(value, value)
+    if isinstance(value, list):
+        return [resolve_placeholders(item, identifiers) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve_placeholders(item, identifiers)
+                for key, item in value.items()}
+    return value
+
+
+# Applies the writes of a plan made with --plan in order. Files are
+# uploaded from local copies of their submitted_file_name, which is
+# patched back afterwards as in Accession.accession_file. Possible
+# duplicates found on the portal by then are reported and skipped, later
+# writes refer to the file on the portal instead.
+def apply_plan(plan_json, shared):
+    with open(plan_json) as plan_file:
+        plan = json.load(plan_file)
+    conn = shared.conn
+    identifiers = {}
+    for operation in plan['operations']:
+        payload = resolve_placeholders(operation['payload'], identifiers)
+        if operation['method'] == 'patch':
+            result = conn.patch(payload, extend_array_values=operation.get(
+                'extend_array_values', False))
+        elif operation.get('upload'):
+            try:
+                result = post_planned_file(shared, payload)
+            except Exception as e:
+                if not (operation.get('possible_duplicate')
+                        and 'Conflict' in str(e)):
+                    raise
+                print('Skipped posting {}, a possible duplicate: {}'.format(
+                    payload['aliases'][0], e), file=sys.stderr)
+                result = conn.get('md5:{}'.format(payload['md5sum']),
+                                  database=True)
+        else:
+            result = conn.post(payload, operation['require_aliases'])
+        for placeholder, key in operation.get('placeholders', {}).items():
+            identifiers[placeholder] = result.get(key)
+
+
+def post_planned_file(shared, payload):
+    filename = payload['submitted_file_name']
+    backend = shared.make_backend(filename)
+    local_file = backend.download(filename)[0]
+    try:
+        posted_file = shared.conn.post(dict(payload,
+                                            submitted_file_name=local_file))
+    finally:
+        backend.release(filename)
+    return shared.conn.patch({'submitted_file_name':    filename,
+                              shared.conn.ENCID_KEY:
+                                  posted_file['accession']},
+                             extend_array_values=False)
@@ -0,0 +1,162 @@
+"""Call counts, latencies and bytes transferred of a run"""
+import inspect
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import accumulate
+
+
+# Upper bounds in seconds of the profiled call latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60]
+
+# Profiled operations whose time adds up to the time spent in a step
+STEP_OPERATIONS = ['accession.start_step', 'accession.accession_task']
+
+
+class Profiler(object):
+    """Call counts, latency histograms and bytes transferred per operation
+
+    Operations are instance methods replaced by timed wrappers, optionally
+    labelled by the step they run for. Bytes are those read from storage
+    and the json bodies sent to or received from the portal.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Statistics keyed by operation name and step label
+        self.operations = OrderedDict()
+
+    def record(self, operation, step, seconds, transferred=0, failed=False):
+        with self.lock:
+            stats = self.operations.setdefault((operation, step), {
+                'calls':    0,
+                'errors':   0,
+                'seconds':  0.0,
+                'bytes':    0,
+                'buckets':  [0] * (len(LATENCY_BUCKETS) + 1)
+            })
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['bytes'] += transferred
+            bucket = len(LATENCY_BUCKETS)
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    bucket = index
+                    break
+            stats['buckets'][bucket] += 1
+
+    # Replaces methods of obj with timed wrappers. count_bytes maps method
+    # names to functions of the call arguments and result returning the
+    # bytes transferred, step_label one of the arguments to the step label.
+    def instrument(self, obj, prefix, methods, count_bytes={},
+                   step_label=None):
+        for name in methods:
+            setattr(obj, name, self.timed('{}.{}'.format(prefix, name),
+                                          getattr(obj, name),
+                                          count_bytes.get(name),
+                                          step_label))
+
+    def timed(self, operation, method, count_bytes=None, step_label=None):
+        def wrapper(*args, **kwargs):
+            step = step_label(args) if step_label else None
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                self.record(operation, step, time.perf_counter() - start,
+                            failed=True)
+                raise
+            if inspect.isgenerator(result):
+                return self.timed_generator(operation, step, start, result)
+            transferred = count_bytes(args, result) if count_bytes else 0
+            self.record(operation, step, time.perf_counter() - start,
+                        transferred)
+            return result
+        return wrapper
+
+    # Generators, e.g. storage streams, are timed until exhausted and
+    # count the bytes of the chunks they yield
+    def timed_generator(self, operation, step, start, generator):
+        transferred = 0
+        try:
+            for chunk in generator:
+                transferred += len(chunk) if isinstance(chunk, bytes) else 0
+                yield chunk
+        except Exception:
+            self.record(operation, step, time.perf_counter() - start,
+                        transferred, failed=True)
+            raise
+        self.record(operation, step, time.perf_counter() - start, transferred)
+
+    # Busy time of every step summed over its start and tasks
+    def step_seconds(self):
+        steps = OrderedDict()
+        with self.lock:
+            for (operation, step), stats in self.operations.items():
+                if step and operation in STEP_OPERATIONS:
+                    steps[step] = steps.get(step, 0.0) + stats['seconds']
+        return steps
+
+    def report(self):
+        operations = []
+        with self.lock:
+            for (operation, step), stats in self.operations.items():
+                cumulative = list(accumulate(stats['buckets']))
+                histogram = OrderedDict(
+                    (str(upper_bound), count)
+                    for upper_bound, count
+                    in zip(LATENCY_BUCKETS + ['+Inf'], cumulative))
+                operations.append(OrderedDict([
+                    ('operation',   operation),
+                    ('step',        step),
+                    ('calls',       stats['calls']),
+                    ('errors',      stats['errors']),
+                    ('seconds',     stats['seconds']),
+                    ('bytes',       stats['bytes']),
+                    ('histogram',   histogram)
+                ]))
+        return {'operations': operations, 'steps': self.step_seconds()}
+
+    # Prometheus text exposition format, samples grouped by metric family
+    def prometheus(self):
+        operations = self.report()['operations']
+        for operation in operations:
+            operation['labels'] = 'operation="{}"'.format(
+                operation['operation'])
+            if operation['step']:
+                operation['labels'] += ',step="{}"'.format(operation['step'])
+        lines = ['# TYPE accession_call_seconds histogram']
+        for operation in operations:
+            for upper_bound, count in operation['histogram'].items():
+                lines.append('accession_call_seconds_bucket{{{},le="{}"}} {}'
+                             .format(operation['labels'], upper_bound, count))
+            lines.append('accession_call_seconds_sum{{{}}} {}'
+                         .format(operation['labels'], operation['seconds']))
+            lines.append('accession_call_seconds_count{{{}}} {}'
+                         .format(operation['labels'], operation['calls']))
+        for name, key in [('accession_call_errors_total', 'errors'),
+                          ('accession_bytes_total', 'bytes')]:
+            lines.append('# TYPE {} counter'.format(name))
+            for operation in operations:
+                lines.append('{}{{{}}} {}'.format(name, operation['labels'],
+                                                  operation[key]))
+        return '\n'.join(lines) + '\n'
+
+    # Writes Prometheus text format to paths ending with .prom, json
+    # otherwise, and prints the per step timing summary
+    def write(self, path):
+        with open(path, 'w') as profile:
+            if path.endswith('.prom'):
+                profile.write(self.prometheus())
+            else:
+                json.dump(self.report(), profile, indent=4)
+        for step, seconds in self.step_seconds().items():
+            print('{:<40} {:>10.2f}s'.format(step, seconds), file=sys.stderr)
+
+
+# Size of json bodies sent to or received from the portal
+def json_size(value):
+    return len(json.dumps(value, default=str))
@@ -0,0 +1,536 @@
+"""Storage backends serving the files of Cromwell workflows"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import copy
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from fnmatch import fnmatch
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from base64 import b64encode, b64decode
+
+
+# Objects up to SMALL_FILE_SIZE bytes are kept in an LRU cache of at most
+# CONTENT_CACHE_SIZE bytes, parsed json files in one of JSON_CACHE_ENTRIES
+SMALL_FILE_SIZE = 4 * 1024 * 1024
+CONTENT_CACHE_SIZE = 64 * 1024 * 1024
+JSON_CACHE_ENTRIES = 32
+
+# Size of the chunks read from storage when streaming uploads
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Number of concurrent GCS requests used to stat files not covered
+# by the workflow root listing
+METADATA_WORKERS = 16
+
+# Downloads are split into ranged requests of DOWNLOAD_SLICE_SIZE bytes
+# made by DOWNLOAD_WORKERS threads, and at most LOCAL_COPIES downloaded
+# files exist at once
+DOWNLOAD_SLICE_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 8
+LOCAL_COPIES = 4
+
+
+class StorageBackend(object):
+    """Interface of the storage holding workflow outputs
+
+    Files are identified by their full URI or path. Subclasses fill
+    blob_metadata with md5sum, size, crc32c and generation per file.
+    """
+    def __init__(self):
+        self.blob_metadata = {}
+        # Local copies made by download, download blocks while
+        # LOCAL_COPIES of them have not been released
+        self.local_mapping = {}
+        self.local_copies = threading.BoundedSemaphore(LOCAL_COPIES)
+
+    # Returns True when value is the name of a file in this storage
+    def is_file(self, value):
+        raise NotImplementedError
+
+    # Returns metadata of the file, stats it on a cache miss
+    def get_blob_metadata(self, file):
+        raise NotImplementedError
+
+    # Yields names of files under prefix, caching their metadata
+    def list(self, prefix):
+        raise NotImplementedError
+
+    # Yields file contents in chunks
+    def stream(self, file, chunk_size=STREAM_CHUNK_SIZE):
+        raise NotImplementedError
+
+    # Fills the metadata cache for files under prefix where a listing
+    # provides it cheaply
+    def cache_blob_metadata(self, prefix):
+        pass
+
+    # Stats files missing from the metadata cache using a bounded
+    # thread pool
+    def prefetch_blob_metadata(self, files, max_workers=METADATA_WORKERS):
+        missing = [file for file in files if file not in self.blob_metadata]
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.get_blob_metadata, missing))
+
+    # Returns md5sum of the file in hex
+    def md5sum(self, file):
+        return self.get_blob_metadata(file)['md5sum']
+
+    def size(self, file):
+        return self.get_blob_metadata(file)['size']
+
+    # Downloads file as string
+    def read_file(self, file):
+        return b''.join(self.stream(file))
+
+    # Read json file
+    def read_json(self, file):
+        return json.loads(self.read_file(file.filename).decode())
+
+    # Downloads file to local filesystem, verifying its md5sum while
+    # it is written
+    def download(self, file):
+        temp_file = self.reserve_local_copy()
+        try:
+            md5 = hashlib.md5()
+            with open(temp_file, 'wb') as local_file:
+                for chunk in self.stream(file):
+                    md5.update(chunk)
+                    local_file.write(chunk)
+            self.verify_download(file, md5)
+        except Exception:
+            self.discard_local_copy(temp_file)
+            raise
+        self.local_mapping[file] = [temp_file, self.md5sum(file)]
+        return self.local_mapping[file]
+
+    # Raises when the hash of the downloaded bytes differs from the one
+    # in the blob metadata. Composite objects are checked by crc32c.
+    def verify_download(self, file, md5, crc32c=None):
+        metadata = self.get_blob_metadata(file)
+        if metadata['md5sum']:
+            matches = md5.hexdigest() == metadata['md5sum']
+        elif crc32c and metadata['crc32c']:
+            matches = (b64encode(crc32c.digest()).decode()
+                       == metadata['crc32c'])
+        else:
+            matches = True
+        if not matches:
+            raise Exception('Downloaded {} does not match its checksum'
+                            .format(file))
+
+    def reserve_local_copy(self):
+        self.local_copies.acquire()
+        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        temp_file.close()
+        return temp_file.name
+
+    def discard_local_copy(self, local_file):
+        if os.path.exists(local_file):
+            os.remove(local_file)
+        self.local_copies.release()
+
+    # Removes the local copy made by download
+    def release(self, file):
+        local_file = self.local_mapping.pop(file, [None])[0]
+        if local_file:
+            self.discard_local_copy(local_file)
+
+
+class GCBackend(StorageBackend):
+    """docstring for GCBackend"""
+    def __init__(self, bucket, slice_size=DOWNLOAD_SLICE_SIZE,
+                 download_workers=DOWNLOAD_WORKERS):
+        super().__init__()
+        self.slice_size = slice_size
+        self.download_workers = download_workers
+        self.bucket_name = bucket
+        self.storage_client = None
+        self.client_lock = threading.Lock()
+        self.buckets = {}
+        # Contents of small files and parsed json files keyed by
+        # (filename, generation)
+        self.content_cache = OrderedDict()
+        self.content_cache_size = 0
+        self.json_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def is_file(self, value):
+        return isinstance(value, str) and 'gs://' in value
+
+    # The client is made on first use, google.cloud.storage is only
+    # imported by runs that read from GCS
+    @property
+    def client(self):
+        with self.client_lock:
+            if self.storage_client is None:
+                from google.cloud import storage
+                self.storage_client = storage.Client()
+        return self.storage_client
+
+    @property
+    def bucket(self):
+        return self.get_bucket(self.bucket_name)
+
+    # Returns a bucket handle, fetching each bucket only once
+    def get_bucket(self, bucket_name):
+        if bucket_name not in self.buckets:
+            self.buckets[bucket_name] = self.client.get_bucket(bucket_name)
+        return self.buckets[bucket_name]
+
+    def blob_from_filename(self, filename):
+        bucket_name = filename.split('gs://')[1].split('/')[0]
+        # Reference genome may reside in different buckets
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.blob(self.file_path(filename, bucket))
+        blob.reload()
+        self.cache_blob(blob)
+        return blob
+
+    # Stores the metadata of a blob returned by reload() or list_blobs()
+    def cache_blob(self, blob):
+        filename = 'gs://{}/{}'.format(blob.bucket.name, blob.name)
+        self.blob_metadata[filename] = {
+            'md5sum':       self.md5_from_blob(blob),
+            'size':         blob.size,
+            'crc32c':       blob.crc32c,
+            'generation':   blob.generation
+        }
+        return self.blob_metadata[filename]
+
+    # Lists blobs under prefix page by page without caching their
+    # metadata, callers cache the blobs they keep
+    def list_blobs(self, prefix):
+        bucket = self.get_bucket(prefix.split('gs://')[1].split('/')[0])
+        return bucket.list_blobs(
+            prefix=self.file_path(prefix, bucket),
+            fields='items(name,md5Hash,size,crc32c,generation),nextPageToken')
+
+    def list(self, prefix):
+        for blob in self.list_blobs(prefix):
+            self.cache_blob(blob)
+            yield 'gs://{}/{}'.format(blob.bucket.name, blob.name)
+
+    # Fills the metadata cache with a single listing of all blobs under
+    # prefix, e.g. the workflow root
+    def cache_blob_metadata(self, prefix):
+        for _ in self.list(prefix):
+            pass
+
+    def get_blob_metadata(self, file):
+        metadata = self.blob_metadata.get(file)
+        if metadata is None:
+            self.blob_from_filename(file)
+            metadata = self.blob_metadata[file]
+        return metadata
+
+    # Converts base64 hash to hex format
+    def md5_from_blob(self, blob):
+        # Composite objects have no md5 hash
+        if blob.md5_hash is None:
+            return None
+        return b64decode(blob.md5_hash).hex()
+
+    # File path without bucket name
+    def file_path(self, file, bucket):
+        file_path = file.split('gs://{}/'.format(bucket.name))[1]
+        return file_path
+
+    # Blob pinned to the generation recorded in the metadata cache,
+    # made without another request
+    def cached_blob(self, file):
+        metadata = self.get_blob_metadata(file)
+        bucket = self.get_bucket(file.split('gs://')[1].split('/')[0])
+        return bucket.blob(self.file_path(file, bucket),
+                           generation=metadata['generation'])
+
+    # Yields file contents in chunks using ranged reads
+    def stream(self, file, chunk_size=STREAM_CHUNK_SIZE):
+        blob = self.cached_blob(file)
+        size = self.size(file)
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size) - 1
+            yield blob.download_as_bytes(start=start, end=end)
+
+    def cache_key(self, file):
+        return (file, self.get_blob_metadata(file)['generation'])
+
+    # Downloads file as string, small files are downloaded once per run
+    def read_file(self, file):
+        key = self.cache_key(file)
+        with self.cache_lock:
+            if key in self.content_cache:
+                self.content_cache.move_to_end(key)
+                return self.content_cache[key]
+        contents = self.cached_blob(file).download_as_bytes()
+        if len(contents) <= SMALL_FILE_SIZE:
+            with self.cache_lock:
+                if key not in self.content_cache:
+                    self.content_cache[key] = contents
+                    self.content_cache_size += len(contents)
+                while self.content_cache_size > CONTENT_CACHE_SIZE:
+                    _, evicted = self.content_cache.popitem(last=False)
+                    self.content_cache_size -= len(evicted)
+        return contents
+
+    # Read json file, callers get their own copy of the parsed json
+    def read_json(self, file):
+        key = self.cache_key(file.filename)
+        with self.cache_lock:
+            parsed = self.json_cache.get(key)
+            if parsed is not None:
+                self.json_cache.move_to_end(key)
+        if parsed is None:
+            parsed = json.loads(self.read_file(file.filename).decode())
+            with self.cache_lock:
+                self.json_cache[key] = parsed
+                while len(self.json_cache) > JSON_CACHE_ENTRIES:
+                    self.json_cache.popitem(last=False)
+        return copy.deepcopy(parsed)
+
+    # Downloads file to a preallocated local file with ranged requests
+    # of slice_size bytes made concurrently. Slices are written in place
+    # as they arrive and hashed in order, at most download_workers slices
+    # ahead of the hash are fetched.
+    def download(self, file):
+        temp_file = self.reserve_local_copy()
+        try:
+            local_file = os.open(temp_file, os.O_WRONLY)
+            try:
+                self.download_slices(file, local_file)
+            finally:
+                os.close(local_file)
+        except Exception:
+            self.discard_local_copy(temp_file)
+            raise
+        self.local_mapping[file] = [temp_file, self.md5sum(file)]
+        return self.local_mapping[file]
+
+    def download_slices(self, file, local_file):
+        blob = self.cached_blob(file)
+        size = self.size(file)
+        preallocate(local_file, size)
+        md5 = hashlib.md5()
+        crc32c = None
+        if not self.md5sum(file):
+            import google_crc32c
+            crc32c = google_crc32c.Checksum()
+
+        def fetch(start):
+            contents = blob.download_as_bytes(
+                start=start, end=min(start + self.slice_size, size) - 1,
+                checksum=None)
+            os.pwrite(local_file, contents, start)
+            return contents
+
+        starts = iter(range(0, size, self.slice_size))
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            pending = deque(executor.submit(fetch, start)
+                            for start in islice(starts, self.download_workers))
+            while pending:
+                contents = pending.popleft().result()
+                for start in islice(starts, 1):
+                    pending.append(executor.submit(fetch, start))
+                (crc32c or md5).update(contents)
+        self.verify_download(file, md5, crc32c)
+
+
+class LocalBackend(StorageBackend):
+    """Outputs of Cromwell runs on a local or shared POSIX filesystem"""
+    def is_file(self, value):
+        return (isinstance(value, str)
+                and (value.startswith('/') or value.startswith('file://')))
+
+    def local_path(self, file):
+        return file[len('file://'):] if file.startswith('file://') else file
+
+    # md5sum is computed over a memory map of the file, generation is
+    # the modification time
+    def get_blob_metadata(self, file):
+        metadata = self.blob_metadata.get(file)
+        if metadata is None:
+            path = self.local_path(file)
+            stat = os.stat(path)
+            md5 = hashlib.md5()
+            if stat.st_size:
+                with open(path, 'rb') as local_file:
+                    with mmap.mmap(local_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as contents:
+                        md5.update(contents)
+            metadata = {
+                'md5sum':       md5.hexdigest(),
+                'size':         stat.st_size,
+                'crc32c':       None,
+                'generation':   stat.st_mtime_ns
+            }
+            self.blob_metadata[file] = metadata
+        return metadata
+
+    # Size only needs a stat
+    def size(self, file):
+        if file in self.blob_metadata:
+            return self.blob_metadata[file]['size']
+        return os.stat(self.local_path(file)).st_size
+
+    def list(self, prefix):
+        path = self.local_path(prefix)
+        if os.path.isfile(path):
+            yield prefix
+            return
+        for root, _, names in os.walk(path):
+            for name in sorted(names):
+                yield os.path.join(root, name)
+
+    def stream(self, file, chunk_size=STREAM_CHUNK_SIZE):
+        with open(self.local_path(file), 'rb') as local_file:
+            for chunk in iter(lambda: local_file.read(chunk_size), b''):
+                yield chunk
+
+    def read_file(self, file):
+        with open(self.local_path(file), 'rb') as local_file:
+            return local_file.read()
+
+    # Local files are uploaded in place
+    def download(self, file):
+        self.local_mapping[file] = [self.local_path(file), self.md5sum(file)]
+        return self.local_mapping[file]
+
+    def release(self, file):
+        self.local_mapping.pop(file, None)
+
+
+class MemoryBackend(StorageBackend):
+    """In-memory storage for tests and offline benchmarks
+
+    files maps mem:// URIs to their contents, every request sleeps for
+    latency seconds and is counted in requests.
+    """
+    def __init__(self, files=None, latency=0):
+        super().__init__()
+        self.files = dict(files or {})
+        self.latency = latency
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def request(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def is_file(self, value):
+        return isinstance(value, str) and value.startswith('mem://')
+
+    def get_blob_metadata(self, file):
+        if file not in self.blob_metadata:
+            self.request('stat')
+            self.cache_file(file)
+        return self.blob_metadata[file]
+
+    def cache_file(self, file):
+        contents = self.files[file]
+        self.blob_metadata[file] = {
+            'md5sum':       hashlib.md5(contents).hexdigest(),
+            'size':         len(contents),
+            'crc32c':       None,
+            'generation':   1
+        }
+
+    # Listing returns the metadata of every file in a single request
+    # like a bucket listing does
+    def list(self, prefix):
+        self.request('list')
+        for file in sorted(self.files):
+            if file.startswith(prefix):
+                self.cache_file(file)
+                yield file
+
+    def cache_blob_metadata(self, prefix):
+        for _ in self.list(prefix):
+            pass
+
+    def stream(self, file, chunk_size=STREAM_CHUNK_SIZE):
+        contents = self.files[file]
+        for start in range(0, len(contents), chunk_size):
+            self.request('read')
+            yield contents[start:start + chunk_size]
+
+
+# Reserves size bytes for a file written out of order
+def preallocate(local_file, size):
+    try:
+        os.posix_fallocate(local_file, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(local_file, size)
+
+
+# Chooses the storage backend by the URI scheme of the workflow root,
+# download_options are passed to GCBackend. Roots on other storage, like
+# s3://, are refused rather than read as local paths.
+def backend_for(workflow_root, **download_options):
+    if workflow_root.startswith('gs://'):
+        return GCBackend(workflow_root.split('gs://')[1].split('/')[0],
+                         **download_options)
+    if LocalBackend().is_file(workflow_root):
+        return LocalBackend()
+    raise Exception('No storage backend for workflow root {}, only gs://, '
+                    'file:// and absolute paths are supported'.format(
+                        workflow_root))
+
+
+# Downloads metadata jsons under path, which may contain glob patterns,
+# e.g. gs://bucket/atac/*/metadata.json. Only the part before the first
+# glob character is listed, server side and page by page, and matching
+# files are downloaded concurrently while the listing continues. Files
+# are named by their path below the listed directory with / replaced by
+# -, e.g. run1-metadata.json, as many share the same name. Buckets may hold
+# millions of other objects, only metadata of the matching files is kept.
+def filter_outputs_by_path(path, output_dir='.', manifest=None,
+                           max_workers=METADATA_WORKERS):
+    bucket, _, pattern = path.split('gs://')[1].partition('/')
+    google_backend = GCBackend(bucket)
+    prefix = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+    directory = prefix[:prefix.rfind('/') + 1]
+
+    def download(file, local_path):
+        google_backend.cached_blob(file).download_to_filename(local_path)
+        return local_path
+
+    os.makedirs(output_dir, exist_ok=True)
+    downloads = []
+    local_paths = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for blob in google_backend.list_blobs('gs://{}/{}'.format(bucket,
+                                                                  prefix)):
+            name = blob.name
+            if not name.endswith('.json'):
+                continue
+            if prefix != pattern and not fnmatch(name, pattern):
+                continue
+            file = 'gs://{}/{}'.format(bucket, name)
+            google_backend.cache_blob(blob)
+            local_path = os.path.join(
+                output_dir, name[len(directory):].strip('/').replace('/', '-'))
+            if local_path in local_paths:
+                raise Exception('{} and {} would both be downloaded to {}'.format(
+                    local_paths[local_path], file, local_path))
+            local_paths[local_path] = file
+            downloads.append((file, executor.submit(download, file,
+                                                    local_path)))
+    filtered = []
+    for file, future in downloads:
+        metadata = dict(google_backend.blob_metadata[file])
+        metadata['filename'] = file
+        metadata['local_path'] = future.result()
+        filtered.append(metadata)
+    if manifest:
+        with open(manifest, 'w') as manifest_file:
+            json.dump(filtered, manifest_file, indent=4)
+    return filtered
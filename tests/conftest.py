@@ -0,0 +1,96 @@
+"""Fixtures of the tests, run with python -m pytest tests
+
+The modules of src and the in-memory portal of the offline benchmark are
+put on the path, nothing is sent over the network.
+"""
+import hashlib
+import json
+import os
+import sys
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import benchmark_accession  # noqa: E402
+from portal import SharedState  # noqa: E402
+from storage_backends import MemoryBackend  # noqa: E402
+
+
+class Workflow(object):
+    """Synthetic ATAC-seq run of the benchmark whose conservative IDR peaks
+    are identical to the optimal ones, and helpers to accession it"""
+    def __init__(self, directory, scatter_width=2):
+        self.scatter_width = scatter_width
+        metadata = benchmark_accession.make_metadata(scatter_width, 0, 0)
+        for shard in metadata['calls']['atac.reproducibility_idr']:
+            shard['outputs']['conservative_peak'] = benchmark_accession.path(
+                'idr/conservative.narrowPeak.gz')
+        self.files = benchmark_accession.make_files(metadata, scatter_width)
+        self.files[benchmark_accession.path(
+            'idr/conservative.narrowPeak.gz')] = self.files[
+                benchmark_accession.path('idr/optimal.narrowPeak.gz')]
+        steps = benchmark_accession.make_steps()
+        steps[4]['wdl_files'].append(dict(
+            steps[4]['wdl_files'][0],
+            filekey='conservative_peak',
+            output_type='conservative idr thresholded peaks',
+            possible_duplicate=True))
+        self.metadata = metadata
+        self.steps = steps
+        self.directory = str(directory)
+        self.metadata_json = benchmark_accession.write_json(
+            metadata, self.directory, 'metadata.json')
+        self.steps_json = benchmark_accession.write_json(
+            steps, self.directory, 'steps.json')
+
+    # Portal with the raw fastqs of the run already on it
+    def make_portal(self):
+        portal = benchmark_accession.FakePortal()
+        for rep in range(1, self.scatter_width + 1):
+            for read in [1, 2]:
+                fastq = benchmark_accession.path(
+                    'fastqs/rep{}_R{}.fastq.gz'.format(rep, read))
+                portal.add({
+                    'md5sum':   hashlib.md5(self.files[fastq]).hexdigest(),
+                    'dataset':  '/experiments/ENCSR000BEN/',
+                    'biological_replicates': [rep],
+                    'status':   'released'})
+        return portal
+
+    def make_shared(self, portal, planning=False):
+        shared = SharedState('test', rate=1e6, connect=lambda server: portal)
+        shared.planning = planning
+        shared.backends['mem'] = MemoryBackend(self.files)
+        shared.session.session.mount(
+            portal.dcc_url, benchmark_accession.PortalAdapter(portal))
+        shared.current_user = '/users/test/'
+        return shared
+
+    def write_steps(self, steps):
+        self.steps_json = benchmark_accession.write_json(
+            steps, self.directory, 'steps.json')
+
+
+# Accessioned files on portal, with the types of their quality metrics
+def portal_files(portal):
+    objects = {id(obj): obj for obj in portal.objects.values()}.values()
+    return sorted((obj['output_type'],
+                   obj['md5sum'],
+                   obj['submitted_file_name'],
+                   sorted(qc['@type'][0] for qc in obj['quality_metrics']))
+                  for obj in objects
+                  if 'derived_from' in obj)
+
+
+def write_json(obj, directory, name):
+    path = os.path.join(str(directory), name)
+    with open(path, 'w') as json_file:
+        json.dump(obj, json_file)
+    return path
+
+
+@pytest.fixture
+def workflow(tmpdir):
+    return Workflow(tmpdir)
@@ -0,0 +1,284 @@
+import json
+import os
+import pytest
+import benchmark_accession
+from analysis import RunJournal
+from accessioning import Accession, load_fingerprints
+from portal import apply_plan
+from conftest import portal_files
+
+
+def accession(workflow, shared, workers=1, **kwargs):
+    accessioner = Accession(workflow.steps_json, workflow.metadata_json,
+                            'test', '/labs/test/', 'U41HG000000',
+                            shared=shared, **kwargs)
+    accessioner.accession_steps(workers)
+    return accessioner
+
+
+def make_plan(workflow, portal):
+    shared = workflow.make_shared(portal, planning=True)
+    accession(workflow, shared)
+    plan_json = os.path.join(workflow.directory, 'plan.json')
+    shared.conn.write(plan_json)
+    return plan_json
+
+
+def test_threaded_engine_matches_serial(workflow):
+    serial = workflow.make_portal()
+    accession(workflow, workflow.make_shared(serial))
+    threaded = workflow.make_portal()
+    accession(workflow, workflow.make_shared(threaded), workers=4)
+    assert portal_files(threaded) == portal_files(serial)
+
+
+def test_plan_skips_possible_duplicates(workflow):
+    portal = workflow.make_portal()
+    before = dict(portal.requests)
+    with open(make_plan(workflow, portal)) as plan_file:
+        plan = json.load(plan_file)
+    assert portal.requests.get('post') == before.get('post')
+    actions = {}
+    for planned_file in plan['files']:
+        actions.setdefault(planned_file['action'], []).append(
+            os.path.basename(planned_file['filename']))
+    assert actions['skip'] == ['conservative.narrowPeak.gz']
+    assert 'optimal.narrowPeak.gz' in actions['post']
+
+
+def test_applied_plan_matches_accessioning(workflow):
+    accessioned = workflow.make_portal()
+    accession(workflow, workflow.make_shared(accessioned))
+    planned = workflow.make_portal()
+    apply_plan(make_plan(workflow, planned), workflow.make_shared(planned))
+    assert portal_files(planned) == portal_files(accessioned)
+
+
+# A possible duplicate posted by someone else between plan and apply is
+# skipped, and later writes go to the file on the portal
+def test_apply_skips_conflicts_of_possible_duplicates(workflow, capsys):
+    portal = workflow.make_portal()
+    plan_json = make_plan(workflow, portal)
+    with open(plan_json) as plan_file:
+        plan = json.load(plan_file)
+    [optimal] = [operation
+                 for operation in plan['operations']
+                 if operation['payload'].get('output_type')
+                 == 'optimal idr thresholded peaks']
+    optimal['possible_duplicate'] = True
+    with open(plan_json, 'w') as plan_file:
+        json.dump(plan, plan_file)
+    existing = portal.add({'md5sum': optimal['payload']['md5sum'],
+                           'output_type': 'optimal idr thresholded peaks',
+                           'submitted_file_name': 'earlier',
+                           'derived_from': [],
+                           'status': 'released'})
+    apply_plan(plan_json, workflow.make_shared(portal))
+    assert 'a possible duplicate' in capsys.readouterr().err
+    idr_files = [portal_file
+                 for portal_file in portal_files(portal)
+                 if portal_file[0] == 'optimal idr thresholded peaks']
+    assert idr_files == [('optimal idr thresholded peaks',
+                          existing['md5sum'], 'earlier',
+                          ['IDRQualityMetric'])]
+
+
+# Outputs of a step added to the steps json after a run are accessioned by
+# incremental runs against it
+def test_incremental_run_accessions_added_steps(workflow):
+    portal = workflow.make_portal()
+    workflow.write_steps(workflow.steps[:-1])
+    shared = workflow.make_shared(portal)
+    shared.fingerprint_dir = workflow.directory
+    first = accession(workflow, shared)
+    fingerprint = first.fingerprint()
+    fingerprint['workflow_id'] = 'earlier'
+    assert 'overlap/reproducibility_overlap' not in fingerprint['steps']
+
+    workflow.write_steps(workflow.steps)
+    shared = workflow.make_shared(portal)
+    shared.previous_runs = [fingerprint]
+    before = portal_files(portal)
+    rerun = accession(workflow, shared)
+    assert [step['dcc_step_run'] for step in rerun.pending_steps()] == [
+        'overlap']
+    added = [portal_file
+             for portal_file in portal_files(portal)
+             if portal_file not in before]
+    assert [portal_file[0] for portal_file in added] == ['replicated peaks']
+    assert sorted(rerun.fingerprint()['steps']) == sorted(
+        first.step_name(step) for step in workflow.steps)
+
+
+def test_fingerprints_are_loaded_from_directories(workflow):
+    portal = workflow.make_portal()
+    shared = workflow.make_shared(portal)
+    shared.fingerprint_dir = workflow.directory
+    accession(workflow, shared)
+    [fingerprint] = load_fingerprints([workflow.directory])
+    assert fingerprint['workflow_id'] == 'cromwell-benchmark'
+    try:
+        load_fingerprints([workflow.metadata_json])
+    except Exception as e:
+        assert 'not a fingerprint' in str(e)
+    else:
+        raise AssertionError('metadata json accepted as fingerprint')
+
+
+# Files are journaled only once submitted_file_name is patched back to
+# their storage path, reruns skip the files journaled or on the portal
+def test_files_are_journaled_after_their_name_is_patched(workflow):
+    portal = workflow.make_portal()
+    patch = portal.patch
+    failed = []
+
+    def fail_once(payload, **kwargs):
+        if 'submitted_file_name' in payload and not failed:
+            failed.append(payload[portal.ENCID_KEY])
+            raise Exception('503 Server Error: Service Unavailable')
+        return patch(payload, **kwargs)
+
+    portal.patch = fail_once
+    with pytest.raises(Exception, match='503'):
+        accession(workflow, workflow.make_shared(portal),
+                  journal_dir=workflow.directory)
+    journal = RunJournal(workflow.directory, 'cromwell-benchmark')
+    journal.close()
+    names = {portal.lookup(accession_id)['md5sum']:
+             portal.lookup(accession_id).get('submitted_file_name')
+             for accession_id in portal.objects
+             if accession_id.startswith('ENCFF')}
+    assert [md5sum
+            for md5sum, name in names.items()
+            if name and not name.startswith('mem://')] == [
+        portal.lookup(failed[0])['md5sum']]
+    assert all(names[md5sum] is None or names[md5sum].startswith('mem://')
+               for md5sum in journal.files)
+
+
+# Lookups return what they resolved even when other tasks or workflows
+# evict it from the shared cache meanwhile
+def test_files_at_portal_keeps_files_evicted_meanwhile(workflow):
+    portal = workflow.make_portal()
+    shared = workflow.make_shared(portal)
+    accessioner = Accession(workflow.steps_json, workflow.metadata_json,
+                            'test', '/labs/test/', 'U41HG000000',
+                            shared=shared)
+    get = portal.get
+
+    def evicting_get(*args, **kwargs):
+        shared.portal_files.clear()
+        return get(*args, **kwargs)
+
+    portal.get = evicting_get
+    fastqs = [file.filename for file in accessioner.analysis.raw_fastqs]
+    bam = benchmark_accession.path('rep1/aligned.bam')
+    encode_files = accessioner.files_at_portal(fastqs + [bam])
+    accessioner.close()
+    assert [encode_file['md5sum']
+            for encode_file in encode_files[:-1]] == [
+        accessioner.file_md5sum(fastq) for fastq in fastqs]
+    assert encode_files[-1] is None
+
+
+# Like Connection.post, streamed posts return the file already posted
+# under the same alias, which is only uploaded to while it still awaits
+# the same contents
+@pytest.mark.parametrize('status, same_md5sum, uploaded', [
+    ('uploading', True, True),
+    ('uploading', False, False),
+    ('in progress', True, False)])
+def test_streamed_uploads_only_go_to_files_awaiting_them(
+        workflow, status, same_md5sum, uploaded):
+    accessioner = Accession(workflow.steps_json, workflow.metadata_json,
+                            'test', '/labs/test/', 'U41HG000000',
+                            stream_uploads=True,
+                            shared=workflow.make_shared(workflow.make_portal()))
+    gs_file = accessioner.analysis.files_by_name[
+        benchmark_accession.path('rep1/aligned.bam')]
+    existing = {'accession': 'ENCFF000AAA',
+                'status': status,
+                'md5sum': gs_file.md5sum if same_md5sum else '0' * 32}
+    uploads = []
+    accessioner.post_file_metadata = lambda encode_file: existing
+    accessioner.stream_upload = (
+        lambda encode_file, gs_file: uploads.append(encode_file['accession']))
+    assert accessioner.accession_file({'aliases': ['test:aligned.bam']},
+                                      gs_file) == existing
+    accessioner.close()
+    assert uploads == (['ENCFF000AAA'] if uploaded else [])
+
+
+# Searches limited to fields leave out empty arrays. Files without
+# quality metrics need no other request, files whose replicates are left
+# out are fetched whole.
+def test_files_for_quality_metrics_fill_in_empty_arrays(workflow):
+    portal = workflow.make_portal()
+    accessioner = Accession(workflow.steps_json, workflow.metadata_json,
+                            'test', '/labs/test/', 'U41HG000000',
+                            shared=workflow.make_shared(portal))
+    accessioner.close()
+    replicated = portal.add({'md5sum': '1' * 32,
+                             'biological_replicates': [1]})
+    unreplicated = portal.add({'md5sum': '2' * 32,
+                               'biological_replicates': []})
+    before = dict(portal.requests)
+    encode_files = accessioner.files_for_quality_metrics(
+        [replicated['accession'], unreplicated['accession']])
+    assert portal.requests['search'] == before.get('search', 0) + 1
+    assert portal.requests['get'] == before.get('get', 0) + 1
+    assert encode_files[replicated['accession']]['quality_metrics'] == []
+    assert encode_files[unreplicated['accession']] == unreplicated
+
+
+# A failed quality metric does not stop the others, it fails the workflow
+# once all steps are done
+def test_failed_quality_metric_fails_the_workflow_last(workflow, capsys):
+    portal = workflow.make_portal()
+    post = portal.post
+    failed = []
+
+    def fail_once(payload, require_aliases=True):
+        if payload[portal.PROFILE_KEY] == 'idr-quality-metrics' and not failed:
+            failed.append(payload)
+            raise Exception('503 Server Error: Service Unavailable')
+        return post(payload, require_aliases)
+
+    portal.post = fail_once
+    with pytest.raises(Exception, match='1 portal writes failed'):
+        accession(workflow, workflow.make_shared(portal))
+    assert 'Writing idr of' in capsys.readouterr().err
+    served = workflow.make_portal()
+    accession(workflow, workflow.make_shared(served))
+    assert len(portal_files(portal)) == len(portal_files(served))
+    assert sum(len(portal_file[3]) for portal_file in portal_files(portal)) == (
+        sum(len(portal_file[3]) for portal_file in portal_files(served)) - 1)
+
+
+# A resumed run continues where the interrupted one stopped. Files, step
+# runs, quality metrics and blob metadata in the journal are neither
+# looked up nor written again.
+def test_resumed_run_continues_from_the_journal(workflow):
+    portal = workflow.make_portal()
+    post = portal.post
+
+    def interrupt(payload, require_aliases=True):
+        if payload.get('output_type') == 'replicated peaks':
+            raise Exception('Run interrupted')
+        return post(payload, require_aliases)
+
+    portal.post = interrupt
+    with pytest.raises(Exception, match='interrupted'):
+        accession(workflow, workflow.make_shared(portal),
+                  journal_dir=workflow.directory)
+    portal.post = post
+    before = dict(portal.requests)
+    shared = workflow.make_shared(portal)
+    accession(workflow, shared, journal_dir=workflow.directory)
+    assert {name: count - before.get(name, 0)
+            for name, count in portal.requests.items()} == {
+        'search': 1, 'get': 1, 'post': 1, 'patch': 1}
+    assert shared.backends['mem'].requests == {'read': 1}
+    served = workflow.make_portal()
+    accession(workflow, workflow.make_shared(served))
+    assert portal_files(portal) == portal_files(served)
@@ -0,0 +1,106 @@
+import pytest
+import analysis
+import benchmark_accession
+from analysis import Analysis, load_metadata, prune_metadata
+from storage_backends import MemoryBackend
+from conftest import write_json
+
+
+# Cromwell metadata with the parts Analysis drops: call fields, sections
+# and labels it does not use, values that are not files and task names
+# with dots
+def noisy_metadata():
+    metadata = benchmark_accession.make_metadata(2, 1, 1)
+    metadata.update({
+        'id':           'cromwell-benchmark',
+        'status':       'Succeeded',
+        'submittedFiles': {'inputs': '{"atac.fastqs": []}',
+                           'options': {'nested': [{'a': 1}, []]}},
+        'labels':       {'cromwell-workflow-id': 'cromwell-benchmark',
+                         'project': 'test'}
+    })
+    metadata['inputs'].update({'atac.genome': ['/local/genome.tsv', 3, None],
+                               'atac.nested': {'a': [[], {}, 1.5, True]}})
+    metadata['calls']['atac.sub.workflow.task'] = [{
+        'inputs':           {'files': ['gs://b/x', 'not a file', 1],
+                             'empty': {}},
+        'outputs':          {},
+        'executionStatus':  'Done',
+        'callCaching':      {'hit': False, 'hashes': {'a': 'b'}},
+        'backendLogs':      {'log': 'gs://b/log'}
+    }]
+    for shards in metadata['calls'].values():
+        for shard in shards:
+            shard.setdefault('runtimeAttributes', {'docker': 'image'})
+    return metadata
+
+
+def test_stream_metadata_matches_prune_metadata(tmpdir):
+    pytest.importorskip('ijson')
+    metadata = noisy_metadata()
+    metadata_json = write_json(metadata, tmpdir, 'metadata.json')
+    assert load_metadata(metadata_json) == prune_metadata(metadata)
+
+
+@pytest.mark.parametrize('streamed', [True, False])
+def test_empty_metadata_json_is_rejected(tmpdir, monkeypatch, streamed):
+    if streamed:
+        pytest.importorskip('ijson')
+    else:
+        monkeypatch.setattr(analysis, 'ijson', None)
+    metadata_json = write_json({}, tmpdir, 'metadata.json')
+    with pytest.raises(Exception, match='Valid metadata json'):
+        Analysis(metadata_json)
+
+
+# The recursive searches Analysis used before its task graph was built
+def search_up_recursively(task, task_name, filekey, inputs=False):
+    if task_name == task.task_name:
+        section = task.input_files if inputs else task.output_files
+        for file in section:
+            if filekey in file.filekeys:
+                yield file
+    for task_item in set(file.task for file in task.input_files):
+        if task_item:
+            yield from search_up_recursively(task_item, task_name, filekey,
+                                             inputs)
+
+
+def search_down_recursively(task, task_name, filekey):
+    if task_name == task.task_name:
+        for file in task.output_files:
+            if filekey in file.filekeys:
+                yield file
+    for task_item in set(used_by_task
+                         for file in task.output_files
+                         for used_by_task in file.used_by_tasks):
+        yield from search_down_recursively(task_item, task_name, filekey)
+
+
+def test_searches_match_recursive_search(tmpdir):
+    metadata = benchmark_accession.make_metadata(3, 1, 2)
+    backend = MemoryBackend(benchmark_accession.make_files(metadata, 3))
+    workflow = Analysis(write_json(metadata, tmpdir, 'metadata.json'),
+                        make_backend=lambda root: backend)
+    searches = [('trim_adapter', 'fastqs', True),
+                ('bowtie2', 'read_len_log', False),
+                ('macs2', 'bfilt_npeak', False),
+                ('idr_pr', 'idr_plot', False),
+                ('extra_task_1', 'output', False)]
+    found = 0
+    for task in workflow.tasks:
+        for task_name, filekey, inputs in searches:
+            up = list(workflow.search_up(task, task_name, filekey, inputs))
+            assert len(up) == len(set(up))
+            assert set(up) == set(search_up_recursively(task, task_name,
+                                                        filekey, inputs))
+            found += len(up)
+            if inputs:
+                continue
+            down = list(workflow.search_down(task, task_name, filekey))
+            assert len(down) == len(set(down))
+            assert set(down) == set(search_down_recursively(task, task_name,
+                                                            filekey))
+            found += len(down)
+    assert found
+
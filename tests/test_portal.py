@@ -0,0 +1,267 @@
+import json
+import os
+from base64 import b64encode
+import pytest
+import requests
+import benchmark_accession
+import portal
+from portal import (Attachment, JsonBody, PlanConnection, PortalSession,
+                    RateLimiter, SessionRequests, WriteQueue, apply_plan)
+from storage_backends import MemoryBackend
+
+
+class ChunkedBackend(MemoryBackend):
+    """MemoryBackend streaming files in chunks of chunk_size bytes"""
+    def __init__(self, files, chunk_size):
+        super().__init__(files)
+        self.chunk_size = chunk_size
+
+    def stream(self, file, chunk_size=None):
+        return super().stream(file, self.chunk_size)
+
+
+class File(object):
+    """Name and size of a file, like GSFile"""
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+
+
+def attachment(data, chunk_size, mime_type='image/png'):
+    filename = 'mem://test/plot-{}.png'.format(len(data))
+    backend = ChunkedBackend({filename: data}, chunk_size)
+    return Attachment(backend, File(filename, len(data)), mime_type)
+
+
+# Sizes around multiples of 3 split at every chunk boundary
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 4, 5, 6, 7, 100, 1001])
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 5, 7, 64])
+def test_attachment_base64_across_chunks(size, chunk_size):
+    data = os.urandom(size)
+    plot = attachment(data, chunk_size)
+    assert b''.join(plot.base64_chunks()) == b64encode(data)
+    assert len(plot) == len(b''.join(plot.chunks()))
+    assert plot.as_dict() == {
+        'type':     'image/png',
+        'download': 'plot-{}.png'.format(size),
+        'href':     'data:image/png;base64,' + b64encode(data).decode()
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 64])
+def test_json_body_streams_attachments(chunk_size):
+    plot = attachment(os.urandom(100), chunk_size)
+    pdf = attachment(os.urandom(31), chunk_size, 'application/pdf')
+    payload = {'F1': 0.5, 'name': 'réplicate', 'plot': plot,
+               'nested': [1, {'pdf': pdf}], 'same_plot': plot}
+    body = JsonBody(payload)
+    serialized = b''.join(body)
+    assert len(body) == len(serialized)
+    # Every iteration streams the attachments again, as retries do
+    assert b''.join(body) == serialized
+    assert json.loads(serialized.decode()) == {
+        'F1': 0.5, 'name': 'réplicate', 'plot': plot.as_dict(),
+        'nested': [1, {'pdf': pdf.as_dict()}], 'same_plot': plot.as_dict()}
+
+
+def test_planned_patch_extends_arrays_when_applied(tmpdir):
+    portal = benchmark_accession.FakePortal()
+    first = portal.add({'md5sum': '1' * 32})
+    second = portal.add({'md5sum': '2' * 32})
+    portal.objects['/qc/1/'] = {'@id': '/qc/1/',
+                                'quality_metric_of': [first['@id']]}
+    plan = PlanConnection(portal)
+    patched = plan.patch({portal.ENCID_KEY: '/qc/1/',
+                          'quality_metric_of': [second['@id']]})
+    assert patched['quality_metric_of'] == [first['@id'], second['@id']]
+    replaced = plan.patch({portal.ENCID_KEY: second['accession'],
+                           'derived_from': [first['@id']]},
+                          extend_array_values=False)
+    assert replaced['derived_from'] == [first['@id']]
+    assert [operation['extend_array_values']
+            for operation in plan.operations] == [True, False]
+    plan_json = str(tmpdir.join('plan.json'))
+    plan.write(plan_json)
+    apply_plan(plan_json, SharedStub(portal))
+    assert portal.objects['/qc/1/']['quality_metric_of'] == [first['@id'],
+                                                             second['@id']]
+
+
+def test_planned_file_with_planned_md5sum_conflicts():
+    plan = PlanConnection(benchmark_accession.FakePortal())
+    payload = {'aliases': ['lab:optimal'], 'md5sum': '1' * 32,
+               plan.conn.PROFILE_KEY: 'file'}
+    planned = plan.post(payload)
+    assert plan.get('md5:{}'.format('1' * 32)) == planned
+    with pytest.raises(Exception, match='Conflict'):
+        plan.post(dict(payload, aliases=['lab:conservative']),
+                  possible_duplicate=True)
+    assert len(plan.operations) == 1
+
+
+class SharedStub(object):
+    """SharedState of apply_plan, for plans without uploads"""
+    def __init__(self, conn):
+        self.conn = conn
+
+
+def test_write_queue_sends_writes_after_a_failure():
+    write_queue = WriteQueue(max_workers=2)
+    written = []
+
+    def write(name):
+        if name == 'b':
+            raise Exception('503 Server Error: Service Unavailable')
+        written.append(name)
+
+    for name in 'abcd':
+        write_queue.add('write {}'.format(name), write, name)
+    failures = write_queue.flush()
+    assert sorted(written) == ['a', 'c', 'd']
+    assert {description: str(e) for description, e in failures.items()} == {
+        'write b': '503 Server Error: Service Unavailable'}
+    assert write_queue.flush() == {}
+
+
+class Clock(object):
+    """Stand-in for the time module of portal recording sleeps
+
+    Time stands still, like for callers sleeping concurrently.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(portal, 'time', clock)
+    return clock
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError('{} Error'.format(status), response=response)
+
+
+def failing(errors, result='ok'):
+    calls = []
+
+    def function():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return function, calls
+
+
+def test_rate_limiter_queues_callers(clock):
+    limiter = RateLimiter(rate=2)
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == [0.5, 1.0]
+    clock.now += 10
+    clock.sleeps = []
+    limiter.acquire()
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_adapts_to_throttling(clock):
+    limiter = RateLimiter(rate=10)
+    for _ in range(10):
+        limiter.throttled()
+    assert limiter.rate == portal.PORTAL_MIN_RATE
+    limiter.rate = 5
+    limiter.succeeded()
+    assert limiter.rate == 5.2
+    limiter.rate = 10
+    limiter.succeeded()
+    assert limiter.rate == 10
+
+
+# Idempotent requests are retried on server errors, others only when
+# throttled as the portal has not processed them
+@pytest.mark.parametrize('idempotent, status, attempts', [
+    (True, 500, 2),
+    (True, 503, 2),
+    (True, 429, 2),
+    (True, 404, 1),
+    (False, 503, 1),
+    (False, 409, 1),
+    (False, 429, 2)])
+def test_retrying(clock, idempotent, status, attempts):
+    session = PortalSession(rate=1e6)
+    function, calls = failing([http_error(status)])
+    retrying = session.retrying(function, idempotent)
+    if attempts == 1:
+        with pytest.raises(requests.HTTPError):
+            retrying()
+    else:
+        assert retrying() == 'ok'
+    assert len(calls) == attempts
+
+
+def test_retrying_connection_errors_of_idempotent_requests(clock):
+    session = PortalSession(rate=1e6)
+    function, calls = failing([requests.ConnectionError()] * 2)
+    assert session.retrying(function, True)() == 'ok'
+    function, calls = failing([requests.ConnectionError()])
+    with pytest.raises(requests.ConnectionError):
+        session.retrying(function, False)()
+
+
+def test_retrying_gives_up(clock):
+    session = PortalSession(rate=1e6)
+    function, calls = failing([http_error(503)] * (portal.PORTAL_RETRIES + 1))
+    with pytest.raises(requests.HTTPError):
+        session.retrying(function, True)()
+    assert len(calls) == portal.PORTAL_RETRIES + 1
+    assert max(clock.sleeps) <= portal.PORTAL_MAX_BACKOFF
+
+
+# Throttled requests wait for Retry-After before the next request, and
+# the rate is halved
+@pytest.mark.parametrize('retry_after, waited', [('3', 3), ('soon', 0)])
+def test_retrying_waits_for_retry_after(clock, retry_after, waited):
+    session = PortalSession(rate=10)
+    function, calls = failing([http_error(429, {'Retry-After': retry_after})])
+    assert session.retrying(function, False)() == 'ok'
+    assert len(calls) == 2
+    backoff, rate_limit = clock.sleeps
+    assert backoff <= portal.PORTAL_BACKOFF
+    assert waited <= rate_limit < waited + 1
+    assert session.limiter.rate == 5 + 10 / 50
+
+
+def test_session_requests_go_over_the_session():
+    sent = []
+
+    class Adapter(requests.adapters.BaseAdapter):
+        def send(self, request, **kwargs):
+            sent.append((request.method, request.url))
+            response = requests.Response()
+            response.status_code = 200
+            response.request = request
+            return response
+
+        def close(self):
+            pass
+
+    session = requests.Session()
+    session.mount('https://portal.invalid', Adapter())
+    module = SessionRequests(session)
+    module.get('https://portal.invalid/files/', timeout=1)
+    module.patch('https://portal.invalid/files/ENCFF000AAA/', json={})
+    assert sent == [('GET', 'https://portal.invalid/files/'),
+                    ('PATCH', 'https://portal.invalid/files/ENCFF000AAA/')]
+    assert module.codes.NOT_FOUND == 404
+    assert module.exceptions.HTTPError is requests.HTTPError
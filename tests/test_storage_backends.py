@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import tempfile
+from base64 import b64encode
+import pytest
+import storage_backends
+from storage_backends import (GCBackend, LocalBackend, backend_for,
+                              filter_outputs_by_path)
+
+
+class Blob(object):
+    """Blob of the fake GCS bucket"""
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        contents = bucket.contents[name]
+        self.md5_hash = b64encode(hashlib.md5(contents).digest()).decode()
+        self.size = len(contents)
+        self.crc32c = None
+        self.generation = generation or 1
+
+    def reload(self):
+        pass
+
+    def download_to_filename(self, local_path):
+        with open(local_path, 'wb') as local_file:
+            local_file.write(self.bucket.contents[self.name])
+
+    # Ranges starting at an offset in bucket.corrupted come back altered
+    def download_as_bytes(self, start=None, end=None, checksum='md5'):
+        self.bucket.ranges.append((start, end))
+        contents = self.bucket.contents[self.name][
+            start:None if end is None else end + 1]
+        if start in self.bucket.corrupted:
+            contents = bytes(byte ^ 1 for byte in contents)
+        return contents
+
+
+class Bucket(object):
+    """GCS bucket holding contents keyed by blob name"""
+    def __init__(self, name, contents):
+        self.name = name
+        self.contents = contents
+        self.ranges = []
+        self.corrupted = set()
+
+    def blob(self, name, generation=None):
+        return Blob(self, name, generation)
+
+    def list_blobs(self, prefix, fields=None):
+        return (Blob(self, name)
+                for name in sorted(self.contents)
+                if name.startswith(prefix))
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = Bucket('bucket', {})
+    monkeypatch.setattr(GCBackend, 'get_bucket', lambda self, name: bucket)
+    return bucket
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    backends = []
+    init = GCBackend.__init__
+
+    def record(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        backends.append(self)
+
+    monkeypatch.setattr(GCBackend, '__init__', record)
+    return backends
+
+
+def test_filter_outputs_names_files_by_their_path(tmpdir, bucket, backends):
+    bucket.contents.update({
+        'atac/r1/metadata.json':            b'{"id": "r1"}',
+        'atac/r1/call-bowtie2/out.bam':     b'bam',
+        'atac/r1/call-qc/qc.json':          b'{}',
+        'atac/r2/metadata.json':            b'{"id": "r2"}',
+        'other/r3/metadata.json':           b'{"id": "r3"}'
+    })
+    output_dir = str(tmpdir.join('metadata'))
+    manifest = str(tmpdir.join('manifest.json'))
+    filtered = filter_outputs_by_path('gs://bucket/atac/*/metadata.json',
+                                      output_dir, manifest)
+    assert sorted(os.listdir(output_dir)) == ['r1-metadata.json',
+                                              'r2-metadata.json']
+    with open(os.path.join(output_dir, 'r2-metadata.json')) as local_file:
+        assert json.load(local_file) == {'id': 'r2'}
+    with open(manifest) as manifest_file:
+        assert json.load(manifest_file) == filtered
+    assert [(entry['filename'], entry['md5sum'], entry['size'])
+            for entry in filtered] == [
+        ('gs://bucket/atac/r1/metadata.json',
+         hashlib.md5(b'{"id": "r1"}').hexdigest(), 12),
+        ('gs://bucket/atac/r2/metadata.json',
+         hashlib.md5(b'{"id": "r2"}').hexdigest(), 12)]
+    # Only the files downloaded are cached
+    [backend] = backends
+    assert sorted(backend.blob_metadata) == [entry['filename']
+                                             for entry in filtered]
+
+
+def test_filter_outputs_of_a_single_file(tmpdir, bucket, backends):
+    bucket.contents['atac/r1/metadata.json'] = b'{}'
+    filter_outputs_by_path('gs://bucket/atac/r1/metadata.json', str(tmpdir))
+    assert os.listdir(str(tmpdir)) == ['metadata.json']
+
+
+def test_filter_outputs_refuses_to_overwrite(tmpdir, bucket, backends):
+    bucket.contents.update({'runs/a-b/metadata.json': b'{}',
+                            'runs/a/b/metadata.json': b'{}'})
+    with pytest.raises(Exception, match='would both be downloaded'):
+        filter_outputs_by_path('gs://bucket/runs/', str(tmpdir))
+
+
+def test_listing_caches_metadata(bucket):
+    bucket.contents.update({'atac/r1/metadata.json': b'{}',
+                            'atac/r1/out.bam': b'bam'})
+    backend = GCBackend('bucket')
+    assert list(backend.list('gs://bucket/atac/')) == [
+        'gs://bucket/atac/r1/metadata.json', 'gs://bucket/atac/r1/out.bam']
+    assert backend.blob_metadata['gs://bucket/atac/r1/out.bam'] == {
+        'md5sum': hashlib.md5(b'bam').hexdigest(), 'size': 3,
+        'crc32c': None, 'generation': 1}
+
+
+@pytest.mark.parametrize('workflow_root, backend_type', [
+    ('gs://bucket/atac/run', GCBackend),
+    ('/cromwell-executions/atac/run', LocalBackend),
+    ('file:///cromwell-executions/atac/run', LocalBackend)])
+def test_backend_for_workflow_roots(workflow_root, backend_type):
+    assert type(backend_for(workflow_root)) is backend_type
+
+
+@pytest.mark.parametrize('workflow_root', [
+    's3://bucket/atac/run', 'mem://benchmark/atac/', 'cromwell-executions/atac'])
+def test_backend_for_refuses_other_storage(workflow_root):
+    with pytest.raises(Exception, match='No storage backend'):
+        backend_for(workflow_root)
+
+
+@pytest.fixture
+def local_files(tmpdir):
+    root = tmpdir.mkdir('atac')
+    root.join('metadata.json').write_binary(b'{}')
+    root.mkdir('call-bowtie2').join('aligned.bam').write_binary(b'bam' * 1000)
+    root.join('empty.txt').write_binary(b'')
+    return str(root)
+
+
+@pytest.mark.parametrize('scheme', ['', 'file://'])
+def test_local_backend_hashes_files_in_place(local_files, scheme):
+    backend = LocalBackend()
+    bam = scheme + os.path.join(local_files, 'call-bowtie2', 'aligned.bam')
+    empty = scheme + os.path.join(local_files, 'empty.txt')
+    assert backend.is_file(bam)
+    assert backend.md5sum(bam) == hashlib.md5(b'bam' * 1000).hexdigest()
+    assert backend.md5sum(empty) == hashlib.md5(b'').hexdigest()
+    assert backend.size(bam) == 3000
+    assert b''.join(backend.stream(bam, 7)) == b'bam' * 1000
+    assert backend.read_file(bam) == b'bam' * 1000
+
+
+def test_local_backend_sizes_files_without_hashing(local_files):
+    backend = LocalBackend()
+    assert backend.size(os.path.join(local_files, 'metadata.json')) == 2
+    assert backend.blob_metadata == {}
+
+
+# Local files are uploaded from where they are, without copies counted
+# against LOCAL_COPIES, and stay there when released
+def test_local_backend_downloads_in_place(local_files):
+    backend = LocalBackend()
+    bam = 'file://' + os.path.join(local_files, 'call-bowtie2', 'aligned.bam')
+    local_path = bam[len('file://'):]
+    for _ in range(storage_backends.LOCAL_COPIES + 1):
+        assert backend.download(bam) == [local_path, backend.md5sum(bam)]
+    backend.release(bam)
+    backend.release(bam)
+    assert os.path.exists(local_path)
+    assert backend.local_mapping == {}
+
+
+def test_local_backend_lists_files(local_files):
+    backend = LocalBackend()
+    assert sorted(backend.list(local_files)) == [
+        os.path.join(local_files, 'call-bowtie2', 'aligned.bam'),
+        os.path.join(local_files, 'empty.txt'),
+        os.path.join(local_files, 'metadata.json')]
+    metadata_json = os.path.join(local_files, 'metadata.json')
+    assert list(backend.list(metadata_json)) == [metadata_json]
+
+
+# Downloads fetch ranges of slice_size bytes concurrently and verify the
+# md5sum of the whole file
+@pytest.mark.parametrize('size', [0, 1, 64, 1000])
+def test_download_in_slices(bucket, size):
+    contents = os.urandom(size)
+    bucket.contents['atac/aligned.bam'] = contents
+    backend = GCBackend('bucket', slice_size=64, download_workers=3)
+    local_path, md5sum = backend.download('gs://bucket/atac/aligned.bam')
+    with open(local_path, 'rb') as local_file:
+        assert local_file.read() == contents
+    assert md5sum == hashlib.md5(contents).hexdigest()
+    assert sorted(bucket.ranges) == [(start, min(start + 64, size) - 1)
+                                     for start in range(0, size, 64)]
+    backend.release('gs://bucket/atac/aligned.bam')
+    assert not os.path.exists(local_path)
+
+
+def test_download_of_corrupted_slice_fails(bucket):
+    bucket.contents['atac/aligned.bam'] = os.urandom(1000)
+    bucket.corrupted.add(640)
+    backend = GCBackend('bucket', slice_size=64, download_workers=3)
+    local_files = set(os.listdir(tempfile.gettempdir()))
+    for _ in range(storage_backends.LOCAL_COPIES + 1):
+        with pytest.raises(Exception, match='does not match its checksum'):
+            backend.download('gs://bucket/atac/aligned.bam')
+    # Failed downloads leave no local copies behind
+    assert set(os.listdir(tempfile.gettempdir())) <= local_files
+    assert backend.local_mapping == {}
+
+
+# Composite objects have no md5 hash and are checked by crc32c
+def test_download_of_composite_object_checks_crc32c(bucket, monkeypatch):
+    google_crc32c = pytest.importorskip('google_crc32c')
+    contents = os.urandom(1000)
+    bucket.contents['atac/aligned.bam'] = contents
+    crc32c = b64encode(google_crc32c.Checksum(contents).digest()).decode()
+    init = Blob.__init__
+
+    def composite(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        self.md5_hash = None
+        self.crc32c = crc32c
+
+    monkeypatch.setattr(Blob, '__init__', composite)
+    backend = GCBackend('bucket', slice_size=64, download_workers=3)
+    local_path = backend.download('gs://bucket/atac/aligned.bam')[0]
+    with open(local_path, 'rb') as local_file:
+        assert local_file.read() == contents
+    backend.release('gs://bucket/atac/aligned.bam')
+    bucket.corrupted.add(0)
+    with pytest.raises(Exception, match='does not match its checksum'):
+        backend.download('gs://bucket/atac/aligned.bam')
+
+
+class File(object):
+    """GSFile stand-in, read_json takes files rather than names"""
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def reads(bucket):
+    return [name for name, _ in bucket.ranges]
+
+
+@pytest.fixture
+def small_caches(bucket, monkeypatch):
+    monkeypatch.setattr(storage_backends, 'SMALL_FILE_SIZE', 5)
+    monkeypatch.setattr(storage_backends, 'CONTENT_CACHE_SIZE', 10)
+    monkeypatch.setattr(storage_backends, 'JSON_CACHE_ENTRIES', 2)
+    bucket.contents.update({'a': b'aaaa', 'b': b'bbbb', 'c': b'cccc',
+                            'large': b'large!'})
+    return bucket
+
+
+# Small files are evicted least recently used first once the cache holds
+# more than CONTENT_CACHE_SIZE bytes, larger files are never cached
+def test_read_file_evicts_least_recently_used(small_caches):
+    backend = GCBackend('bucket')
+    read = []
+
+    def read_file(name):
+        before = len(small_caches.ranges)
+        assert backend.read_file('gs://bucket/' + name) == (
+            small_caches.contents[name])
+        if len(small_caches.ranges) > before:
+            read.append(name)
+
+    for name in ['a', 'b', 'a', 'c', 'a', 'b', 'large', 'large']:
+        read_file(name)
+    assert read == ['a', 'b', 'c', 'b', 'large', 'large']
+    assert backend.content_cache_size <= 10
+
+
+def test_read_file_reads_new_generations(small_caches):
+    backend = GCBackend('bucket')
+    backend.read_file('gs://bucket/a')
+    backend.blob_metadata['gs://bucket/a']['generation'] = 2
+    small_caches.contents['a'] = b'AAAA'
+    assert backend.read_file('gs://bucket/a') == b'AAAA'
+
+
+def test_read_json_evicts_least_recently_used(small_caches):
+    small_caches.contents.update({'1.json': b'{"n": 1}',
+                                  '2.json': b'{"n": 2}',
+                                  '3.json': b'{"n": 3}'})
+    backend = GCBackend('bucket')
+    parsed = []
+    for name in ['1.json', '2.json', '1.json', '3.json']:
+        parsed.append(backend.read_json(File('gs://bucket/' + name)))
+    assert list(backend.json_cache) == [('gs://bucket/1.json', 1),
+                                        ('gs://bucket/3.json', 1)]
+    # Callers get their own copies
+    parsed[0]['n'] = 0
+    assert backend.read_json(File('gs://bucket/1.json')) == {'n': 1}